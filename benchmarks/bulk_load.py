@@ -0,0 +1,80 @@
+"""
+Compare the rows per second of executing the extended INSERTs of a
+dump one by one (what every importer does in the end) with loading
+the same rows with wpsync.bulk_load (LOAD DATA LOCAL INFILE).
+
+This needs pymysql and a MySQL or MariaDB server with a throwaway
+database that allows local_infile. All tables in that database may
+be overwritten!
+
+Usage (from the repository root):
+  WPSYNC_BENCH_MYSQL="host:port:user:pass:database" \\
+    python -m benchmarks.bulk_load [rows...]
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from wpsync import bulk_load
+from wpsync.sql_dump import is_insert, iter_statements, open_dump
+from .import_database_dump import HEADER, make_dumps
+
+
+def create_table(db):
+    with db.cursor() as cursor:
+        for statement in HEADER.split(";")[:2]:
+            cursor.execute(statement)
+
+
+def execute_inserts(db, dump):
+    with db.cursor() as cursor, open_dump(dump) as f:
+        for statement in iter_statements(f):
+            if is_insert(statement):
+                cursor.execute(statement.decode("utf-8"))
+    db.commit()
+
+
+def main():
+    if "WPSYNC_BENCH_MYSQL" not in os.environ:
+        print(__doc__)
+        sys.exit(1)
+    if bulk_load.pymysql is None:
+        print("This needs pymysql")
+        sys.exit(1)
+    host, port, user, password, database = os.environ[
+        "WPSYNC_BENCH_MYSQL"
+    ].split(":")
+    site = {
+        "mysql_user": user,
+        "mysql_pass": password,
+        "mysql_name": database,
+    }
+    db = bulk_load.connect((host, int(port)), site)
+    sizes = [int(a) for a in sys.argv[1:]] or [20000, 200000]
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for rows in sizes:
+            single, extended = make_dumps(tmp, rows)
+            for name, load in [
+                ("inserts", lambda: execute_inserts(db, extended)),
+                (
+                    "load data",
+                    lambda: bulk_load.load_table(
+                        db, "wp_postmeta", extended, tmp
+                    ),
+                ),
+            ]:
+                create_table(db)
+                start = time.perf_counter()
+                load()
+                seconds = time.perf_counter() - start
+                print(
+                    f"{rows:>9} rows  {name:<10}"
+                    f" {seconds:8.2f} s  {rows / seconds:10.0f} rows/s"
+                )
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
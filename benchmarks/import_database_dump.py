@@ -0,0 +1,119 @@
+"""
+Compare the rows per second of the old import path (one INSERT per
+row, one query per line) with extended-insert dumps imported by the
+current import-sql-database-mysql.php.
+
+This needs the php command line client (with mysqli) and a MySQL
+or MariaDB server with a throwaway database. All tables in that
+database may be overwritten!
+
+Usage (from the repository root):
+  WPSYNC_BENCH_MYSQL="host:port:user:pass:database" \\
+    python -m benchmarks.import_database_dump [rows...]
+"""
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+
+this_dir = Path(__file__).resolve().parent
+legacy_importer = this_dir / "legacy-import-sql-database-mysql.php"
+importer = this_dir.parent / "wpsync" / "import-sql-database-mysql.php"
+net_buffer_length = 1000000
+
+HEADER = """DROP TABLE IF EXISTS `wp_postmeta`;
+CREATE TABLE `wp_postmeta` (
+  `meta_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `post_id` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `meta_key` varchar(255) DEFAULT NULL,
+  `meta_value` longtext,
+  PRIMARY KEY (`meta_id`),
+  KEY `post_id` (`post_id`),
+  KEY `meta_key` (`meta_key`(191))
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+RUNNER = """<?php
+include_once('{importer}');
+IMPORT_TABLES('{host}', '{user}', '{password}', '{database}', {port}, '{dump}');
+"""
+
+
+def row(i):
+    return (
+        f"({i},{i // 10},'_meta_key_{i % 50}',"
+        f"'a:1:{{s:3:\\\"url\\\";s:24:\\\"https://example.com/{i:04}\\\";}}')"
+    )
+
+
+def make_dumps(tmp, rows):
+    single = tmp / "single.sql"
+    extended = tmp / "extended.sql"
+    with open(single, "w") as f:
+        f.write(HEADER)
+        for i in range(1, rows + 1):
+            f.write(f"INSERT INTO `wp_postmeta` VALUES {row(i)};\n")
+    with open(extended, "w") as f:
+        f.write(HEADER)
+        line = ""
+        for i in range(1, rows + 1):
+            if not line:
+                line = f"INSERT INTO `wp_postmeta` VALUES {row(i)}"
+            else:
+                line += f",{row(i)}"
+            if len(line) > net_buffer_length:
+                f.write(line + ";\n")
+                line = ""
+        if line:
+            f.write(line + ";\n")
+    return single, extended
+
+
+def import_dump(php_importer, dump, mysql, tmp):
+    host, port, user, password, database = mysql
+    runner = tmp / "runner.php"
+    runner.write_text(
+        RUNNER.format(
+            importer=php_importer,
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            database=database,
+            dump=dump,
+        )
+    )
+    start = time.perf_counter()
+    process = subprocess.run(["php", str(runner)], stdout=subprocess.PIPE)
+    seconds = time.perf_counter() - start
+    if b"Error" in process.stdout:
+        print(process.stdout.decode("utf8")[:1000])
+    return seconds
+
+
+def main():
+    if "WPSYNC_BENCH_MYSQL" not in os.environ:
+        print(__doc__)
+        sys.exit(1)
+    mysql = os.environ["WPSYNC_BENCH_MYSQL"].split(":")
+    sizes = [int(a) for a in sys.argv[1:]] or [20000, 200000]
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for rows in sizes:
+            single, extended = make_dumps(tmp, rows)
+            for name, php_importer, dump in [
+                ("legacy", legacy_importer, single),
+                ("extended", importer, extended),
+            ]:
+                seconds = import_dump(php_importer, dump, mysql, tmp)
+                print(
+                    f"{rows:>9} rows  {name:<10}"
+                    f" {seconds:8.2f} s  {rows / seconds:10.0f} rows/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Compare the streaming restore.replace_in_database_dump with the
+old implementation that parsed the whole dump with sqlparse.
+
+Usage (from the repository root):
+  python -m benchmarks.replace_in_database_dump [megabytes...]
+
+Each implementation runs in its own process so the reported peak
+memory (maxrss) belongs to it alone.
+"""
+import resource
+import sys
+import time
+from multiprocessing import Process, Queue
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import sqlparse
+from wpsync.restore import replace_in_database_dump
+
+
+TO_SET = {"CHARSET": "utf8", "ENGINE": "MyISAM"}
+
+CREATE_TABLE = """--
+-- Table structure for table `wp_posts_{n}`
+--
+
+DROP TABLE IF EXISTS `wp_posts_{n}`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `wp_posts_{n}` (
+  `ID` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `post_title` text COLLATE utf8mb4_unicode_ci NOT NULL,
+  `post_content` longtext COLLATE utf8mb4_unicode_ci NOT NULL,
+  PRIMARY KEY (`ID`)
+) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+"""
+
+INSERT = (
+    "INSERT INTO `wp_posts_{n}` VALUES ({i},'Post {i}; \\'quoted\\'',"
+    "'<p>Lorem ipsum dolor sit amet, https://example.com/?p={i}; "
+    'a:1:{{s:3:\\"url\\";s:19:\\"https://example.com\\";}}</p>\');\n'
+)
+
+
+def legacy_replace_in_database_dump(in_file, out_file, to_set):
+    db_dump = in_file.read_text(encoding="utf-8")
+    statements = sqlparse.parse(db_dump)
+    detected_keyword = None
+    serialised = []
+    detected_collate = False
+    for statement in statements:
+        if statement.token_first().value == "CREATE":
+            for token in statement.flatten():
+                if token.value in to_set:
+                    detected_keyword = token.value
+                elif (
+                    detected_keyword
+                    and token.ttype == sqlparse.tokens.Token.Name
+                ):
+                    token.value = to_set[detected_keyword]
+                    detected_keyword = None
+                elif token.value == "COLLATE":
+                    detected_collate = True
+                    token.value = ""
+                elif (
+                    detected_collate
+                    and token.ttype != sqlparse.tokens.Token.Name
+                ):
+                    token.value = ""
+                elif (
+                    detected_collate
+                    and token.ttype == sqlparse.tokens.Token.Name
+                ):
+                    token.value = ""
+                    detected_collate = False
+        serialised.append(str(statement))
+    out_file.write_text("".join(serialised), encoding="utf-8")
+
+
+def make_dump(path, megabytes, rows_per_table=5000):
+    target = megabytes * 1024 * 1024
+    written = 0
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            chunk = CREATE_TABLE.format(n=n)
+            chunk += "".join(
+                INSERT.format(n=n, i=i) for i in range(rows_per_table)
+            )
+            f.write(chunk)
+            written += len(chunk)
+            n += 1
+
+
+def run(implementation, in_file, out_file, queue):
+    start = time.perf_counter()
+    implementation(in_file, out_file, TO_SET)
+    seconds = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, maxrss))
+
+
+def measure(implementation, in_file, out_file):
+    queue = Queue()
+    process = Process(
+        target=run, args=(implementation, in_file, out_file, queue)
+    )
+    process.start()
+    process.join()
+    return queue.get()
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [5, 20]
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for megabytes in sizes:
+            in_file = tmp / f"dump-{megabytes}.sql"
+            make_dump(in_file, megabytes)
+            results = {}
+            for name, implementation in [
+                ("legacy", legacy_replace_in_database_dump),
+                ("streaming", replace_in_database_dump),
+            ]:
+                out_file = tmp / f"{name}-{megabytes}.sql"
+                results[name] = measure(implementation, in_file, out_file)
+                seconds, maxrss = results[name]
+                print(
+                    f"{megabytes:>6} MB  {name:<10}"
+                    f" {seconds:8.2f} s  {maxrss / 1024:8.1f} MB maxrss"
+                )
+            legacy = (tmp / f"legacy-{megabytes}.sql").read_bytes()
+            streaming = (tmp / f"streaming-{megabytes}.sql").read_bytes()
+            # the old implementation drops whitespace at the very end
+            identical = legacy.rstrip() == streaming.rstrip()
+            print(f"{'':>6}     output identical: {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+<?php
+// The wpsync agent. It is uploaded into the wpsync dir once per
+// connection, with WPSYNC_TOKEN and $wpsync_database defined in front
+// of this file, and runs batches of operations:
+//
+//   POST agent.php
+//   {"token": "...", "operations": [{"op": "stat", ...}, ...]}
+//
+// For every operation, a line of JSON is sent back as soon as it is
+// done, {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+// The operations after one that failed are skipped. Operations that
+// take long may send {"progress": ...} lines while they run.
+
+ini_set('display_errors', 0);
+error_reporting(E_ALL);
+set_time_limit(0);
+
+function wpsync_send($line) {
+    echo json_encode($line) . "\n";
+    while (ob_get_level() > 0) {
+        ob_end_flush();
+    }
+    flush();
+}
+
+function wpsync_progress($progress) {
+    wpsync_send(array('progress' => $progress));
+}
+
+// paths of files in the wpsync dir
+function wpsync_file($name) {
+    if ($name === '' || strpos($name, '..') !== false) {
+        throw new Exception("Invalid file name: $name");
+    }
+    return __DIR__ . '/' . $name;
+}
+
+// paths relative to the base dir of the site
+function wpsync_site_path($path) {
+    if (strpos('/' . $path . '/', '/../') !== false) {
+        throw new Exception("Invalid path: $path");
+    }
+    return rtrim(dirname(__DIR__) . '/' . $path, '/');
+}
+
+function wpsync_pdo() {
+    global $wpsync_database;
+    return new PDO(
+        wpsync_dsn(),
+        $wpsync_database['user'],
+        $wpsync_database['pass'],
+        array(PDO::ATTR_ERRMODE => PDO::ERRMODE_EXCEPTION)
+    );
+}
+
+function wpsync_dsn() {
+    global $wpsync_database;
+    return 'mysql:host=' . $wpsync_database['host']
+        . ';dbname=' . $wpsync_database['name']
+        . ';port=' . $wpsync_database['port'];
+}
+
+function wpsync_mysqldump($operation, $settings = array()) {
+    global $wpsync_database;
+    include_once(__DIR__ . '/Mysqldump.php');
+    return new Ifsnop\Mysqldump\Mysqldump(
+        wpsync_dsn(),
+        $wpsync_database['user'],
+        $wpsync_database['pass'],
+        array_merge(array(
+            'extended-insert' => true,
+            'net_buffer_length' => $operation['net_buffer_length'],
+            'add-drop-table' => true,
+            'compress' => $operation['compress'],
+        ), $settings)
+    );
+}
+
+// the whole database into one file, or, with "split", every table
+// into a file of its own in database/, described by a manifest that
+// is returned
+function wpsync_op_dump($operation) {
+    if (empty($operation['split'])) {
+        $file = wpsync_file($operation['file']);
+        wpsync_mysqldump($operation)->start($file);
+        return array('bytes' => filesize($file));
+    }
+
+    $pdo = wpsync_pdo();
+    $dir = wpsync_file('database');
+    if (!is_dir($dir)) {
+        mkdir($dir);
+    }
+
+    $tables = array();
+    $views = array();
+    foreach ($pdo->query('SHOW FULL TABLES') as $row) {
+        if ($row[1] === 'VIEW') {
+            $views[] = $row[0];
+        } else {
+            $tables[] = $row[0];
+        }
+    }
+
+    $manifest = array('tables' => array(), 'views' => null);
+    foreach ($tables as $i => $table) {
+        $file = rawurlencode($table) . $operation['suffix'];
+        $dump = wpsync_mysqldump($operation, array('include-tables' => array($table)));
+        $dump->start($dir . '/' . $file);
+        $quoted = '`' . str_replace('`', '``', $table) . '`';
+        $create = $pdo->query("SHOW CREATE TABLE $quoted")->fetch(PDO::FETCH_NUM);
+        $rows = $pdo->query("SELECT COUNT(*) FROM $quoted")->fetchColumn();
+        $manifest['tables'][] = array(
+            'name' => $table,
+            'file' => $file,
+            'rows' => (int) $rows,
+            'bytes' => filesize($dir . '/' . $file),
+            'create' => $create[1],
+        );
+        wpsync_progress(array('table' => $table, 'done' => $i + 1, 'total' => count($tables)));
+    }
+
+    // views may use any of the tables, so they go last, into a file
+    // of their own
+    if (count($views) > 0) {
+        $file = 'views' . $operation['suffix'];
+        $dump = wpsync_mysqldump($operation, array('exclude-tables' => $tables));
+        $dump->start($dir . '/' . $file);
+        $manifest['views'] = array(
+            'names' => $views,
+            'file' => $file,
+            'bytes' => filesize($dir . '/' . $file),
+        );
+    }
+    return $manifest;
+}
+
+// once the dump has started, the status can't be changed any more.
+// if something goes wrong, the dump ends without its "-- Dump
+// completed" footer, which the client checks for
+function wpsync_stream_dump($operation) {
+    header('Content-Type: application/octet-stream');
+    header('X-Accel-Buffering: no');
+    // dumps that aren't stored compressed are at least compressed
+    // for the transfer, if the client accepts that
+    if ($operation['compress'] === 'None') {
+        ini_set('zlib.output_compression', 'On');
+    }
+    try {
+        wpsync_mysqldump($operation)->start('php://output');
+    } catch (Exception $e) {
+        echo "\n-- WPSYNC_ERROR " . $e->getMessage() . "\n";
+    }
+}
+
+function wpsync_tar_header($name, $size, $mtime, $type) {
+    $header = pack(
+        'a100a8a8a8a12a12a8a1a100a6a2a32a32a8a8a155a12',
+        $name, '0000644', '0000000', '0000000',
+        sprintf('%011o', $size), sprintf('%011o', $mtime),
+        '        ', $type, '', 'ustar', '00', '', '', '', '', '', ''
+    );
+    $checksum = array_sum(unpack('C*', $header));
+    return substr_replace($header, sprintf('%06o', $checksum) . "\0 ", 148, 8);
+}
+
+// files below a directory as a tar archive. names longer than a tar
+// header allows get a GNU long name entry in front of them. files
+// that can't be read are left out
+function wpsync_stream_pack($operation) {
+    header('Content-Type: application/x-tar');
+    header('X-Accel-Buffering: no');
+    ini_set('zlib.output_compression', 'On');
+    foreach ($operation['files'] as $path) {
+        try {
+            $file = wpsync_site_path($operation['path'] . '/' . $path);
+        } catch (Exception $e) {
+            continue;
+        }
+        $handle = @fopen($file, 'rb');
+        if ($handle === false) {
+            continue;
+        }
+        $stat = fstat($handle);
+        if (strlen($path) > 100) {
+            echo wpsync_tar_header('././@LongLink', strlen($path) + 1, 0, 'L');
+            echo str_pad($path . "\0", (int) ceil((strlen($path) + 1) / 512) * 512, "\0");
+        }
+        echo wpsync_tar_header($path, $stat['size'], $stat['mtime'], '0');
+        $left = $stat['size'];
+        while ($left > 0) {
+            $chunk = fread($handle, min($left, 1048576));
+            if ($chunk === false || $chunk === '') {
+                break;
+            }
+            echo $chunk;
+            $left -= strlen($chunk);
+        }
+        fclose($handle);
+        // a file that got shorter while it was read is padded, so
+        // the archive stays intact
+        echo str_repeat("\0", $left + (512 - $stat['size'] % 512) % 512);
+    }
+    echo str_repeat("\0", 1024);
+}
+
+// inflate a compressed dump into a plain copy, for max_seconds at
+// most. if the copy is there already, it's continued where it stopped
+function wpsync_op_inflate($operation) {
+    $started = microtime(true);
+    $target = wpsync_file($operation['target']);
+    clearstatcache();
+    $size = file_exists($target) ? filesize($target) : 0;
+    $in = gzopen(wpsync_file($operation['file']), 'rb');
+    if ($in === false) {
+        throw new Exception("Failed to open {$operation['file']}");
+    }
+    if ($size > 0 && gzseek($in, $size) === -1) {
+        gzclose($in);
+        throw new Exception("Failed to seek in {$operation['file']}");
+    }
+    $out = fopen($target, 'ab');
+    while (!gzeof($in)) {
+        $data = gzread($in, 1048576);
+        if ($data === false || ($data === '' && !gzeof($in))) {
+            gzclose($in);
+            fclose($out);
+            throw new Exception("Failed to read {$operation['file']}");
+        }
+        fwrite($out, $data);
+        if (microtime(true) - $started > $operation['max_seconds']) {
+            break;
+        }
+    }
+    $done = gzeof($in);
+    gzclose($in);
+    fclose($out);
+    return array('done' => $done);
+}
+
+// one chunk of an import (see import-sql-database-mysql.php)
+function wpsync_op_import($operation) {
+    global $wpsync_database;
+    include_once(__DIR__ . '/import-sql-database-mysql.php');
+    $path = wpsync_file($operation['file']);
+    if (!empty($operation['compressed'])) {
+        $path = 'compress.zlib://' . $path;
+    }
+    ob_start();
+    IMPORT_TABLES(
+        $wpsync_database['host'],
+        $wpsync_database['user'],
+        $wpsync_database['pass'],
+        $wpsync_database['name'],
+        $wpsync_database['port'],
+        $path,
+        $operation['offset'],
+        $operation['max_seconds']
+    );
+    $output = ob_get_clean();
+    $offset = null;
+    if (preg_match('/WPSYNC_OFFSET (\d+)/', $output, $match)) {
+        $offset = (int) $match[1];
+    }
+    return array(
+        'offset' => $offset,
+        'done' => strpos($output, 'WPSYNC_DONE') !== false,
+        'output' => trim(preg_replace('/WPSYNC_(OFFSET \d+|DONE)/', '', $output)),
+    );
+}
+
+function wpsync_op_replace($operation) {
+    global $wpsync_database;
+    require_once(__DIR__ . '/srdb.class.php');
+    // icit_srdb runs stripcslashes on its arguments
+    $escape = function ($string) {
+        return addcslashes($string, '\\');
+    };
+    ob_start();
+    $report = new icit_srdb(array(
+        'verbose' => true,
+        'dry_run' => false,
+        'hybrid' => true,
+        'host' => $wpsync_database['host'],
+        'name' => $wpsync_database['name'],
+        'user' => $wpsync_database['user'],
+        'pass' => $wpsync_database['pass'],
+        'port' => $wpsync_database['port'],
+        'search' => array_map($escape, $operation['search']),
+        'replace' => array_map($escape, $operation['replace']),
+        'tables' => $operation['tables'],
+        'include_cols' => $operation['include_cols'],
+    ));
+    ob_end_clean();
+
+    if (!$report) {
+        throw new Exception("The search-replace-database-tool didn't return a report.");
+    }
+    if (!empty($report->errors['results'])) {
+        throw new Exception(implode("\n", $report->errors['results']));
+    }
+    return array('tables' => count($operation['tables']));
+}
+
+function wpsync_stat($path) {
+    if (is_dir($path)) {
+        return array('type' => 'dir', 'size' => 0, 'mtime' => filemtime($path));
+    }
+    if (is_file($path)) {
+        return array('type' => 'file', 'size' => filesize($path), 'mtime' => filemtime($path));
+    }
+    return null;
+}
+
+function wpsync_op_stat($operation) {
+    $stats = array();
+    foreach ($operation['paths'] as $path) {
+        $stats[$path] = wpsync_stat(wpsync_site_path($path));
+    }
+    return $stats;
+}
+
+// everything below a directory, with paths relative to it:
+// {"files": [[path, size, mtime], ...], "dirs": [path, ...]}. the
+// wpsync dir is left out
+function wpsync_op_manifest($operation) {
+    $root = wpsync_site_path($operation['path']);
+    if (!is_dir($root)) {
+        throw new Exception("Not a directory: {$operation['path']}");
+    }
+    $entries = new RecursiveIteratorIterator(
+        new RecursiveDirectoryIterator($root, FilesystemIterator::SKIP_DOTS),
+        RecursiveIteratorIterator::SELF_FIRST
+    );
+    $manifest = array('files' => array(), 'dirs' => array());
+    foreach ($entries as $entry) {
+        $pathname = $entry->getPathname();
+        if ($pathname === __DIR__ || strpos($pathname, __DIR__ . '/') === 0) {
+            continue;
+        }
+        $path = substr($pathname, strlen($root) + 1);
+        if ($entry->isDir()) {
+            $manifest['dirs'][] = $path;
+        } elseif ($entry->isFile()) {
+            $manifest['files'][] = array($path, $entry->getSize(), $entry->getMTime());
+        }
+    }
+    return $manifest;
+}
+
+function wpsync_op_has_extension($operation) {
+    return extension_loaded($operation['name']);
+}
+
+function wpsync_remove_tree($dir) {
+    $entries = new RecursiveIteratorIterator(
+        new RecursiveDirectoryIterator($dir, FilesystemIterator::SKIP_DOTS),
+        RecursiveIteratorIterator::CHILD_FIRST
+    );
+    foreach ($entries as $entry) {
+        if ($entry->isDir() && !$entry->isLink()) {
+            rmdir($entry->getPathname());
+        } else {
+            unlink($entry->getPathname());
+        }
+    }
+    rmdir($dir);
+}
+
+// apply the changes to a directory that were uploaded as a zip:
+// {"op": "unpack", "path": ..., "archive": <zip in the wpsync dir>,
+// "mtimes": {path: mtime, ...}, "delete": [path, ...]}. the zip is
+// extracted next to itself first, so nothing is touched if that
+// fails, then the deletions are applied and the extracted files are
+// moved into place one by one
+function wpsync_op_unpack($operation) {
+    $root = wpsync_site_path($operation['path']);
+    $archive = wpsync_file($operation['archive']);
+    $staging = $archive . '.d';
+    try {
+        $zip = new ZipArchive;
+        if ($zip->open($archive) !== true || !$zip->extractTo($staging)) {
+            throw new Exception("Failed to extract {$operation['archive']}");
+        }
+        $zip->close();
+
+        foreach ($operation['delete'] as $path) {
+            $target = wpsync_site_path($operation['path'] . '/' . $path);
+            if (is_dir($target) && !is_link($target)) {
+                wpsync_remove_tree($target);
+            } elseif (file_exists($target) || is_link($target)) {
+                unlink($target);
+            }
+        }
+
+        $entries = new RecursiveIteratorIterator(
+            new RecursiveDirectoryIterator($staging, FilesystemIterator::SKIP_DOTS),
+            RecursiveIteratorIterator::SELF_FIRST
+        );
+        $extracted = array();
+        foreach ($entries as $entry) {
+            $extracted[] = array(
+                substr($entry->getPathname(), strlen($staging) + 1),
+                $entry->isDir(),
+            );
+        }
+        $files = 0;
+        foreach ($extracted as list($path, $is_dir)) {
+            $target = $root . '/' . $path;
+            if ($is_dir) {
+                if (!is_dir($target)) {
+                    mkdir($target, 0755);
+                }
+                continue;
+            }
+            if (!rename($staging . '/' . $path, $target)) {
+                throw new Exception("Failed to move $path into place");
+            }
+            if (isset($operation['mtimes'][$path])) {
+                touch($target, $operation['mtimes'][$path]);
+            }
+            $files++;
+        }
+    } finally {
+        @unlink($archive);
+        if (is_dir($staging)) {
+            wpsync_remove_tree($staging);
+        }
+    }
+    return array('files' => $files, 'deleted' => count($operation['delete']));
+}
+
+// fatal errors can't be caught, but we can still tell what happened
+function wpsync_shutdown() {
+    $error = error_get_last();
+    if ($error !== null && in_array($error['type'], array(E_ERROR, E_PARSE, E_CORE_ERROR, E_COMPILE_ERROR))) {
+        wpsync_send(array('ok' => false, 'error' => "{$error['message']} in {$error['file']}:{$error['line']}"));
+    }
+}
+
+$request = json_decode(file_get_contents('php://input'), true);
+if (!is_array($request) || !isset($request['token']) || !hash_equals(WPSYNC_TOKEN, (string) $request['token'])) {
+    http_response_code(403);
+    exit;
+}
+
+// dumps and archives can also be requested as {"token": "...",
+// "stream": {"op": ...}}: they're sent as they are written, instead
+// of being written into a file
+if (isset($request['stream'])) {
+    $function = 'wpsync_stream_' . $request['stream']['op'];
+    if (!function_exists($function)) {
+        http_response_code(400);
+        exit;
+    }
+    $function($request['stream']);
+    exit;
+}
+
+header('Content-Type: application/x-ndjson');
+header('X-Accel-Buffering: no');
+register_shutdown_function('wpsync_shutdown');
+
+foreach ($request['operations'] as $operation) {
+    $function = 'wpsync_op_' . $operation['op'];
+    try {
+        if (!function_exists($function)) {
+            throw new Exception("Unknown operation: {$operation['op']}");
+        }
+        wpsync_send(array('ok' => true, 'result' => $function($operation)));
+    } catch (Exception $e) {
+        wpsync_send(array('ok' => false, 'error' => $e->getMessage()));
+        break;
+    }
+}
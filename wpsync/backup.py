@@ -1,39 +1,21 @@
+import json
+import shutil
 from datetime import datetime
-from pathlib import Path
 from .host_info import HostInfo
 from . import put
 from .connection import RemoteExecutionError
+from .parallel import run_on_handles
+from .sql_dump import (
+    MANIFEST_FILE_NAME,
+    index_dump,
+    index_new_dump,
+    index_path,
+)
 
 
-this_dir = Path(__file__).resolve().parent
-mysqldump_php_template = """<?php
-
-ini_set('display_errors', 1);
-ini_set('display_startup_errors', 1);
-error_reporting(E_ALL);
-
-include_once(__DIR__ . '/Mysqldump.php');
-
-try {{
-
-    $dump = new Ifsnop\Mysqldump\Mysqldump(
-        'mysql:host={mysql_host};dbname={mysql_name};port={mysql_port}',
-        '{mysql_user}',
-        '{mysql_pass}',
-        array(
-            'extended-insert' => false,
-            'add-drop-table' => true,
-        )
-    );
-
-    $dump->start(__DIR__ . '/dump.sql');
-
-}} catch (Exception $e) {{
-
-    http_response_code(500); # internal server error
-    echo $e->getMessage();
-}}
-"""
+# multi-row INSERTs are cut when they get longer than this (in bytes)
+# so they stay well below the usual max_allowed_packet of the target
+net_buffer_length = 1000000
 
 
 def backup(
@@ -48,51 +30,174 @@ def backup(
     if not quiet:
         put.title(f'Creating new backup of {site["name"]}')
 
+    # the components don't depend on each other, so they're run as
+    # separate tasks, each on its own connection handle, and e.g.
+    # the database dump can run while the uploads are transferred
+    tasks = []
     if database or full:
-        if not quiet:
-            put.step("Backing up database")
-        database_backup_dir = backup_dir / "database"
-        local_dump_file = database_backup_dir / "dump.sql"
-        remote_dump_file = connection.normalise("dump.sql")
-        database_backup_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
-
-        php_code = mysqldump_php_template.format(**site)
-        mysqldump_library_local = this_dir / "Mysqldump.php"
-        mysqldump_library_remote = connection.normalise("Mysqldump.php")
-        connection.put(mysqldump_library_local, mysqldump_library_remote)
-        # TODO Connection#run_php returns the response text, do
-        # something with it?
-        try:
-            connection.run_php(php_code)
-            connection.get(remote_dump_file, str(local_dump_file.resolve()))
-        except RemoteExecutionError as error:
-            put.error(error)
-        finally:
-            connection.rm(mysqldump_library_remote)
-            # TODO easier to ask forgiveness
-            if connection.file_exists(remote_dump_file):
-                connection.rm(remote_dump_file)
-
+        tasks.append(lambda c: backup_database(backup_dir, site, c, quiet))
     if uploads:
-        backup_a_dir(backup_dir, site, connection, "uploads", quiet)
-
+        tasks.append(
+            lambda c: backup_a_dir(backup_dir, site, c, "uploads", quiet)
+        )
     if plugins:
-        backup_a_dir(backup_dir, site, connection, "plugins", quiet)
-
+        tasks.append(
+            lambda c: backup_a_dir(backup_dir, site, c, "plugins", quiet)
+        )
     if themes:
-        backup_a_dir(backup_dir, site, connection, "themes", quiet)
-
+        tasks.append(
+            lambda c: backup_a_dir(backup_dir, site, c, "themes", quiet)
+        )
     if full:
-        if not quiet:
-            put.step("Backing up full site")
-        local_dir = backup_dir / "full"
-        remote_dir = site["base_dir"][:-1]
-        local_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
-        connection.mirror(remote_dir, local_dir)
+        tasks.append(lambda c: backup_full(backup_dir, site, c, quiet))
+    run_on_handles(connection, tasks, site["concurrency"])
 
     return fs_ts
 
 
+def backup_database(backup_dir, site, connection, quiet):
+    if not quiet:
+        put.step("Backing up database")
+    database_backup_dir = backup_dir / "database"
+    # with compress_database, the dump is gzipped on the server and
+    # stays compressed in the backup
+    if site["compress_database"]:
+        dump_file_suffix = ".sql.gz"
+        compress = "Gzip"
+    else:
+        dump_file_suffix = ".sql"
+        compress = "None"
+    database_backup_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    dump_operation = {
+        "op": "dump",
+        "compress": compress,
+        "net_buffer_length": net_buffer_length,
+    }
+    # errors aren't caught here: a sync must not go on to restore
+    # when a backup has failed
+    if site["split_database"]:
+        backup_database_tables(
+            database_backup_dir,
+            site,
+            connection,
+            dump_operation,
+            dump_file_suffix,
+            quiet,
+        )
+    else:
+        backup_database_dump(
+            database_backup_dir,
+            site,
+            connection,
+            dump_operation,
+            dump_file_suffix,
+        )
+
+
+def backup_database_dump(
+    database_backup_dir, site, connection, dump_operation, dump_file_suffix
+):
+    dump_file_name = "dump" + dump_file_suffix
+    local_dump_file = database_backup_dir / dump_file_name
+    if connection.has_native_mysql() or site["stream_database"]:
+        stream_dump(connection, dump_operation, local_dump_file)
+    else:
+        fetch_dump(connection, dump_operation, local_dump_file)
+        index_dump(local_dump_file)
+
+
+# the dump is written on the server and then transferred
+def fetch_dump(connection, dump_operation, local_dump_file):
+    remote_dump_file = connection.normalise(local_dump_file.name)
+    try:
+        connection.agent([{**dump_operation, "file": local_dump_file.name}])
+        connection.get(remote_dump_file, str(local_dump_file.resolve()))
+    finally:
+        # TODO easier to ask forgiveness
+        if connection.file_exists(remote_dump_file):
+            connection.rm(remote_dump_file)
+
+
+# the dump is written into the backup as it arrives, from mysqldump
+# on the server if it has one, or else as the response of the agent
+def stream_dump(connection, dump_operation, local_dump_file):
+    try:
+        with open(local_dump_file, "wb") as f:
+            if connection.has_native_mysql():
+                connection.native_dump(dump_operation, f)
+            else:
+                with connection.agent_stream(dump_operation) as response:
+                    shutil.copyfileobj(response, f, 1024 * 1024)
+        # whether the dump is complete is checked while it's indexed,
+        # so it's read only once more
+        error = index_new_dump(local_dump_file)
+        if error is not None:
+            raise RemoteExecutionError(error)
+    except Exception:
+        # don't leave a broken dump in the backup
+        for file in [local_dump_file, index_path(local_dump_file)]:
+            if file.exists():
+                file.unlink()
+        raise
+
+
+def backup_database_tables(
+    database_backup_dir,
+    site,
+    connection,
+    dump_operation,
+    dump_file_suffix,
+    quiet,
+):
+    remote_dir = connection.normalise("database")
+
+    def progress(dumped):
+        if not quiet:
+            put.info(
+                f'Dumped {dumped["table"]}'
+                f' ({dumped["done"]}/{dumped["total"]})'
+            )
+
+    try:
+        [manifest] = connection.agent(
+            [{**dump_operation, "split": True, "suffix": dump_file_suffix}],
+            progress=progress,
+        )
+        with open(
+            database_backup_dir / MANIFEST_FILE_NAME, "w", encoding="utf8"
+        ) as f:
+            json.dump(manifest, f)
+        files = [table["file"] for table in manifest["tables"]]
+        if manifest["views"]:
+            files.append(manifest["views"]["file"])
+
+        # the table files are transferred in parallel
+        def get_file(file_name):
+            return lambda c: c.get(
+                f"{remote_dir}/{file_name}",
+                str((database_backup_dir / file_name).resolve()),
+            )
+
+        run_on_handles(
+            connection,
+            [get_file(file_name) for file_name in files],
+            site["concurrency"],
+        )
+    finally:
+        if connection.dir_exists(remote_dir):
+            connection.rmdir(remote_dir)
+
+
+def backup_full(backup_dir, site, connection, quiet):
+    if not quiet:
+        put.step("Backing up full site")
+    local_dir = backup_dir / "full"
+    remote_dir = site["base_dir"][:-1]
+    local_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    link_dest = previous_backup_of(backup_dir, "full")
+    connection.mirror(remote_dir, local_dir, link_dest=link_dest)
+
+
 def backup_a_dir(backup_dir, site, connection, name, quiet):
     if not quiet:
         put.step(f"Backing up {name}")
@@ -106,4 +211,18 @@ def backup_a_dir(backup_dir, site, connection, name, quiet):
             )
         connection.mkdir(remote_dir)
     local_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
-    connection.mirror(remote_dir, local_dir)
+    link_dest = previous_backup_of(backup_dir, name)
+    connection.mirror(remote_dir, local_dir, link_dest=link_dest)
+
+
+# backups are built against the most recent earlier backup of the
+# same site that has the same component, so that files which haven't
+# changed are hard-linked instead of downloaded and stored again
+def previous_backup_of(backup_dir, name):
+    earlier_backups = [
+        b for b in backup_dir.parent.iterdir() if b.name < backup_dir.name
+    ]
+    for earlier_backup in sorted(earlier_backups, reverse=True):
+        if (earlier_backup / name).is_dir():
+            return (earlier_backup / name).resolve()
+    return None
@@ -0,0 +1,184 @@
+import re
+from contextlib import ExitStack
+from .search_replace import unescape
+from .sql_dump import (
+    is_insert,
+    iter_rows,
+    iter_statements,
+    open_dump,
+    table_of,
+)
+
+# bulk loading is optional, it needs pymysql
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+
+# tables with at least this many rows are bulk loaded, the others
+# aren't worth the detour
+min_rows = 50000
+
+_NUMBER = re.compile(rb"[-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?$")
+_HEX = re.compile(rb"0x((?:[0-9a-fA-F]{2})*)$")
+# what LOAD DATA's default format (tab separated, escaped with \)
+# needs escaped in a field
+_TO_ESCAPE = re.compile(rb"[\\\t\n\r\0]")
+_ESCAPED = {
+    b"\\": b"\\\\",
+    b"\t": b"\\t",
+    b"\n": b"\\n",
+    b"\r": b"\\r",
+    b"\0": b"\\0",
+}
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+# the tables worth bulk loading, given the rows per table
+def large_tables(table_rows):
+    return sorted(
+        table for table, rows in table_rows.items() if rows >= min_rows
+    )
+
+
+def _field(value):
+    if value[:1] == b"'":
+        value = unescape(value[1:-1])
+    elif value.upper() == b"NULL":
+        return b"\\N"
+    elif _HEX.match(value):
+        value = bytes.fromhex(_HEX.match(value)[1].decode("ascii"))
+    elif not _NUMBER.match(value):
+        raise BulkLoadError(f"Can't load values like {value[:20]!r}")
+    return _TO_ESCAPE.sub(lambda m: _ESCAPED[m[0]], value)
+
+
+# the rows of an INSERT statement as lines for LOAD DATA
+def insert_to_lines(statement):
+    values = statement.find(b" VALUES ")
+    if values == -1 or b"(" in statement[:values]:
+        raise BulkLoadError("Can't load INSERTs with a column list")
+    return [
+        b"\t".join(_field(value) for value in row) + b"\n"
+        for row in iter_rows(statement)
+    ]
+
+
+# copy a dump, leaving out the INSERTs into the tables in table_files,
+# which are written to a dump of their own per table instead. those
+# start with the statements from the head of the dump that set up the
+# session (character set, sql mode ...)
+def split_inserts(dump_file, rest_file, table_files):
+    head = []
+    in_head = True
+    with ExitStack() as stack:
+        source = stack.enter_context(open_dump(dump_file))
+        rest = stack.enter_context(open_dump(rest_file, "wb"))
+        targets = {}
+        for statement in iter_statements(source):
+            table = table_of(statement)
+            if table is not None:
+                in_head = False
+            elif in_head:
+                head.append(statement)
+            if table in table_files and is_insert(statement):
+                if table not in targets:
+                    targets[table] = stack.enter_context(
+                        open_dump(table_files[table], "wb")
+                    )
+                    targets[table].writelines(head)
+                targets[table].write(statement)
+            else:
+                rest.write(statement)
+
+
+def connect(address, site):
+    host, port = address
+    return pymysql.connect(
+        host=host,
+        port=port,
+        user=site["mysql_user"],
+        password=site["mysql_pass"],
+        database=site["mysql_name"],
+        charset="utf8mb4",
+        local_infile=True,
+        autocommit=False,
+    )
+
+
+# load the rows of a table's dump into the (existing) table with
+# LOAD DATA LOCAL INFILE, by way of a tab separated file in temp_dir.
+# the session is set up like the dump's head sets it up (time zone,
+# sql mode ...) so the values are read as they would be by the INSERTs
+def load_table(db, table, table_file, temp_dir):
+    tsv_file = temp_dir / f"{table_file.name}.tsv"
+    quoted = "`" + table.replace("`", "``") + "`"
+    head = []
+    try:
+        with open(tsv_file, "wb") as tsv, open_dump(table_file) as dump:
+            for statement in iter_statements(dump):
+                if is_insert(statement):
+                    tsv.writelines(insert_to_lines(statement))
+                elif (
+                    statement.strip()
+                    and not statement.startswith(b"--")
+                    and table_of(statement) is None
+                ):
+                    head.append(
+                        statement.strip().rstrip(b";").decode("utf-8")
+                    )
+        with db.cursor() as cursor:
+            for statement in head:
+                cursor.execute(statement)
+            cursor.execute("SET SESSION foreign_key_checks = 0")
+            cursor.execute("SET SESSION unique_checks = 0")
+            cursor.execute(f"ALTER TABLE {quoted} DISABLE KEYS")
+            try:
+                cursor.execute(
+                    f"LOAD DATA LOCAL INFILE %s INTO TABLE {quoted}"
+                    " CHARACTER SET utf8mb4",
+                    (str(tsv_file),),
+                )
+            finally:
+                cursor.execute(f"ALTER TABLE {quoted} ENABLE KEYS")
+        db.commit()
+    except pymysql.MySQLError as error:
+        # the table is imported normally after this, so it has to be
+        # empty again (it was before, it's only just been created)
+        try:
+            db.rollback()
+            with db.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {quoted}")
+            db.commit()
+        except pymysql.MySQLError:
+            pass
+        raise BulkLoadError(str(error))
+    finally:
+        if tsv_file.exists():
+            tsv_file.unlink()
+
+
+def load_tables(address, site, table_files, temp_dir):
+    """
+    Bulk load the tables in table_files (dumps that contain only
+    their INSERTs) through the MySQL server at address. Returns the
+    tables that couldn't be loaded, mapped to why.
+    """
+    try:
+        db = connect(address, site)
+    except pymysql.MySQLError as error:
+        return {table: str(error) for table in table_files}
+    failed = {}
+    try:
+        for table, table_file in table_files.items():
+            try:
+                load_table(db, table, table_file, temp_dir)
+            except BulkLoadError as error:
+                failed[table] = str(error)
+    finally:
+        db.close()
+    return failed
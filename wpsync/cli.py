@@ -5,8 +5,8 @@ Synchronise WordPress sites across ssh, (s)ftp and local hosts
 Usage:
   wpsync [-q] [-c file] [-l] (sync|s) ((-d|-u|-p|-t)... | -a | -f) <source> <dest>
   wpsync [-q] [-c file] [-l] (backup|b) ((-d|-u|-p|-t)... | -a | -f) <source>
-  wpsync [-q] [-c file] [-l] (restore|r) [(-d|-u|-p|-t)... | -a | -f] [-b backup] [-s site]
-  wpsync [-q] [-c file] [-l] (list|l) [(-d|-u|-p|-t)... | -a | -f] [-s site]
+  wpsync [-q] [-c file] [-l] (restore|r) [(-d|-u|-p|-t)... | -a | -f] [-b backup] [-s site] [--tables=tables]
+  wpsync [-q] [-c file] [-l] (list|l) [(-d|-u|-p|-t)... | -a | -f] [-s site] [--tables=tables]
   wpsync [-q] [-c file] [-l] (install|i) <site>
   wpsync -h | --help
   wpsync -V | --version
@@ -30,6 +30,8 @@ Options:
   -t --themes                Sync/Backup/Restore the themes.
   -a --all                   Sync/Backup/Restore all of the above.
   -f --full                  Sync/Backup/Restore the full site.
+  --tables=tables            Restore only these (comma-separated) tables,
+                             or list their row counts in each backup.
 """
 # The (-d|-u|-p|-t)... thing is a hack to make docopt accept any,
 # but at least one of -d, -u, -p, -t.
@@ -53,11 +55,12 @@ from .cli_helpers import (
     get_options,
     get_wpsyncdir,
 )
-from .connection import connect
+from .connection import RemoteExecutionError, connect
 from .backup import backup as _backup
 from .restore import restore as _restore
 from .list_backups import list_backups as _list_backups
 from .install import install as _install
+from .parallel import run_parallel
 from . import put
 
 
@@ -71,8 +74,6 @@ from . import put
 # - support databases with multiple installations or other stuff
 #   than wordpress in them, add an optional 'mysql_prefix'
 #   configuration option for that
-# - unify all php code together into one server.php so we only have
-#   to upload it once on connect
 # - maybe add an option to persistently install the server? (no!)
 # - make the server safer by using http simple auth with
 #   automatically, per-connection generated passwords
@@ -167,19 +168,39 @@ def sync(arguments, config, config_path, wpsyncdir, options):
     assert_site_exists(config, arguments["<dest>"])
     source = config[arguments["<source>"]]
     dest = config[arguments["<dest>"]]
-    with connect(source) as connection:
-        backup_id = _backup(
-            wpsyncdir, source, connection, arguments["--quiet"], **options
-        )
-    with connect(dest) as connection:
-        _backup(wpsyncdir, dest, connection, arguments["--quiet"], **options)
+    quiet = arguments["--quiet"]
+    with connect(dest) as dest_connection:
+
+        # the backup of the source and the safety backup of the
+        # destination don't depend on each other, so they run at
+        # the same time; only the restore has to wait for both
+        def backup_source():
+            with put.prefix(source["name"]), connect(source) as connection:
+                return _backup(wpsyncdir, source, connection, quiet, **options)
+
+        def backup_dest():
+            with put.prefix(dest["name"]):
+                return _backup(
+                    wpsyncdir, dest, dest_connection, quiet, **options
+                )
+
+        if source is dest:
+            backup_tasks = [backup_dest]
+        else:
+            backup_tasks = [backup_source, backup_dest]
+        try:
+            backup_id = run_parallel(backup_tasks, len(backup_tasks))[0]
+        except Exception as error:
+            put.error(f'Backup failed, not restoring {dest["name"]}: {error}')
+            sys.exit(1)
+
         _restore(
             wpsyncdir,
             source,
             dest,
-            connection,
+            dest_connection,
             backup_id,
-            arguments["--quiet"],
+            quiet,
             **options,
         )
 
@@ -188,7 +209,13 @@ def backup(arguments, config, config_path, wpsyncdir, options):
     assert_site_exists(config, arguments["<source>"])
     site = config[arguments["<source>"]]
     with connect(site) as connection:
-        _backup(wpsyncdir, site, connection, arguments["--quiet"], **options)
+        try:
+            _backup(
+                wpsyncdir, site, connection, arguments["--quiet"], **options
+            )
+        except RemoteExecutionError as error:
+            put.error(error)
+            sys.exit(1)
 
 
 def restore(arguments, config, config_path, wpsyncdir, options):
@@ -267,6 +294,13 @@ def restore(arguments, config, config_path, wpsyncdir, options):
     else:
         backup_id = backup_id.replace(":", "_")
 
+    # restoring only some tables implies restoring the database
+    tables = None
+    if arguments["--tables"]:
+        tables = [t.strip() for t in arguments["--tables"].split(",")]
+        if not any(options.values()):
+            options["database"] = True
+
     # if no options are set, detect and use the options from the
     # backup we're going to restore.
     if not any(options.values()):
@@ -287,6 +321,7 @@ def restore(arguments, config, config_path, wpsyncdir, options):
             connection,
             backup_id,
             arguments["--quiet"],
+            tables=tables,
             **options,
         )
 
@@ -300,7 +335,11 @@ def list_backups(arguments, config, config_path, wpsyncdir, options):
         site_names = [
             (site, config[site]["fs_safe_name"]) for site in config.keys()
         ]
-    _list_backups(wpsyncdir, site_names, **options)
+    tables = None
+    if arguments["--tables"]:
+        tables = [t.strip() for t in arguments["--tables"].split(",")]
+        options["database"] = True
+    _list_backups(wpsyncdir, site_names, tables=tables, **options)
 
 
 def install(arguments, config, config_path, wpsyncdir, options):
@@ -122,6 +122,38 @@ def validate_config_sections(config):
                 Optional("no_verify_ssl"): Regex(
                     r"(true|false|yes|no|0|1)$", flags=re.IGNORECASE
                 ),
+                # how many connections to the host may be used at
+                # the same time, e.g. to import that many tables of a
+                # split_database backup at once (some shared hosts
+                # limit this)
+                Optional("concurrency"): Regex(r"[1-9][0-9]*$"),
+                # dump the database gzip-compressed on the server and
+                # keep it compressed in the backup
+                Optional("compress_database"): Regex(
+                    r"(true|false|yes|no|0|1)$", flags=re.IGNORECASE
+                ),
+                # dump every table into a file of its own
+                Optional("split_database"): Regex(
+                    r"(true|false|yes|no|0|1)$", flags=re.IGNORECASE
+                ),
+                # receive the dump as it is written, over http, instead
+                # of writing it on the server and fetching it from
+                # there (not with split_database)
+                Optional("stream_database"): Regex(
+                    r"(true|false|yes|no|0|1)$", flags=re.IGNORECASE
+                ),
+                # load the big tables with LOAD DATA LOCAL INFILE when
+                # restoring to an ssh or file site (needs pymysql)
+                Optional("bulk_load"): Regex(
+                    r"(true|false|yes|no|0|1)$", flags=re.IGNORECASE
+                ),
+                # where the urls in the database are replaced when
+                # restoring to another site: in the dump, before it
+                # is uploaded, or on the server, after the import
+                Optional("search_replace"): Or("local", "remote"),
+                # more strings to replace when restoring to this site,
+                # one "search => replace" per line
+                Optional("search_replace_pairs"): str,
             },
         }
     )
@@ -186,6 +218,53 @@ def normalize_config(config, defaults):
             site["no_verify_ssl"] = bool(RE_TRUE.match(site["no_verify_ssl"]))
         else:
             site["no_verify_ssl"] = False
+        if "compress_database" in site:
+            site["compress_database"] = bool(
+                RE_TRUE.match(site["compress_database"])
+            )
+        else:
+            site["compress_database"] = False
+        if "split_database" in site:
+            site["split_database"] = bool(
+                RE_TRUE.match(site["split_database"])
+            )
+        else:
+            site["split_database"] = False
+        if "stream_database" in site:
+            site["stream_database"] = bool(
+                RE_TRUE.match(site["stream_database"])
+            )
+        else:
+            site["stream_database"] = False
+        if "bulk_load" in site:
+            site["bulk_load"] = bool(RE_TRUE.match(site["bulk_load"]))
+        else:
+            site["bulk_load"] = False
+        if "search_replace" not in site:
+            site["search_replace"] = "local"
+        pairs = []
+        for line in site.get("search_replace_pairs", "").splitlines():
+            if not line.strip():
+                continue
+            problem = None
+            if "=>" not in line:
+                problem = "missing =>"
+            else:
+                search, replace = (s.strip() for s in line.split("=>", 1))
+                if not search:
+                    problem = "empty search"
+                elif search == replace:
+                    problem = "search and replace are the same"
+            if problem is not None:
+                print(f"search_replace_pairs: {problem} in {line.strip()}")
+                print(f"please check {site_name} in your config")
+                sys.exit(1)
+            pairs.append((search, replace))
+        site["search_replace_pairs"] = pairs
+        if "concurrency" in site:
+            site["concurrency"] = int(site["concurrency"])
+        else:
+            site["concurrency"] = 2
 
     return config
 
@@ -1,12 +1,29 @@
+import json
 import os
+import re
 import shutil
+import socket
+import tarfile
+import time
+import zipfile
+import zlib
+from fnmatch import fnmatch
 from shlex import quote
-from contextlib import contextmanager
-from tempfile import NamedTemporaryFile
+from contextlib import ExitStack, contextmanager
+from tempfile import (
+    NamedTemporaryFile,
+    TemporaryDirectory,
+    TemporaryFile,
+    mkdtemp,
+)
 from pathlib import Path
-from subprocess import run, PIPE
+from subprocess import run, Popen, DEVNULL, PIPE, STDOUT, TimeoutExpired
+from threading import Lock, Thread
 from sh import rsync, scp, ssh, ErrorReturnCode_1
+from uuid import uuid4
 import requests
+import urllib3
+from . import put
 
 
 @contextmanager
@@ -17,9 +34,20 @@ def connect(site):
         connection = FTPConnection(site)
     else:
         connection = SSHConnection(site)
-    connection.make_wpsync_dir()
-    yield connection
-    connection.remove_wpsync_dir()
+    try:
+        connection.open()
+        connection.make_wpsync_dir()
+    except BaseException:
+        # there's no wpsync dir to remove yet, but the session to the
+        # host (ssh master, lftp process) has to be closed
+        connection.session.close()
+        connection.close()
+        raise
+    try:
+        connection.upload_agent()
+        yield connection
+    finally:
+        connection.remove_wpsync_dir()
 
 
 # a helper function for dealing with different forms of paths
@@ -33,21 +61,149 @@ class RemoteExecutionError(Exception):
     pass
 
 
+this_dir = Path(__file__).resolve().parent
+# put in front of agent.php when it's uploaded
+agent_config_php_template = """<?php
+define('WPSYNC_TOKEN', {token});
+$wpsync_database = array(
+    'host' => {mysql_host},
+    'name' => {mysql_name},
+    'user' => {mysql_user},
+    'pass' => {mysql_pass},
+    'port' => {mysql_port},
+);
+"""
+# the libraries the agent needs for an operation, uploaded the first
+# time they're needed
+agent_libraries = {
+    "dump": ["Mysqldump.php"],
+    "import": ["import-sql-database-mysql.php"],
+    "replace": ["srdb.class.php"],
+}
+
+
+RE_ERROR = re.compile("error|Error|ERROR")
+
+
+def php_string(value):
+    value = value.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{value}'"
+
+
+# recreate the tree at source_dir in target_dir with hard links
+# to the files in source_dir
+def link_tree(source_dir, target_dir):
+    source_dir = Path(source_dir)
+    target_dir = Path(target_dir)
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        relative = Path(dirpath).relative_to(source_dir)
+        (target_dir / relative).mkdir(mode=0o755, parents=True, exist_ok=True)
+        for filename in filenames:
+            target = target_dir / relative / filename
+            if not target.exists():
+                os.link(Path(dirpath) / filename, target)
+
+
+# the files below local_dir as {relative path: (size, mtime)}, and
+# the set of directories below it
+def local_manifest(local_dir):
+    files = {}
+    dirs = set()
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        relative = Path(dirpath).relative_to(local_dir)
+        for dirname in dirnames:
+            dirs.add((relative / dirname).as_posix())
+        for filename in filenames:
+            stat = os.lstat(os.path.join(dirpath, filename))
+            files[(relative / filename).as_posix()] = (
+                stat.st_size,
+                int(stat.st_mtime),
+            )
+    return files, dirs
+
+
 class Connection:
     def __init__(self, site):
         self.site = site
         self.wpsync_dir = site["base_dir"] + "wpsync"
+        self.agent_token = None
+        self.agent_libraries = set()
+        self.agent_lock = Lock()
+        self.session = self.make_session()
+        # handles are made for the tasks of a pool (see
+        # parallel.run_on_handles)
+        self.is_handle = False
 
     def normalise(self, path):
         return f"{self.wpsync_dir}/{s(path)}"
 
+    # the wpsync dir relative to remote_path, or None if it isn't in
+    # there. mirrors leave it out both ways: a backup mustn't contain
+    # the agent (with the credentials in it) or half-written dumps,
+    # and a restore mustn't overwrite the agent that's running
+    def wpsync_dir_in(self, remote_path):
+        path = s(remote_path).rstrip("/") + "/"
+        if not self.wpsync_dir.startswith(path):
+            return None
+        return self.wpsync_dir[len(path) :]
+
+    def rsync_excludes(self, remote_path, exclude=[]):
+        args = [f"--exclude={quote(pattern)}" for pattern in exclude]
+        wpsync_dir = self.wpsync_dir_in(remote_path)
+        if wpsync_dir is not None:
+            args.append(f"--exclude=/{wpsync_dir}/")
+        return args
+
+    def lftp_excludes(self, remote_path, exclude=[]):
+        args = "".join(f" --exclude {quote(pattern)}" for pattern in exclude)
+        wpsync_dir = self.wpsync_dir_in(remote_path)
+        if wpsync_dir is not None:
+            args += f" --exclude {quote(f'^{re.escape(wpsync_dir)}/$')}"
+        return args
+
+    # open and close may be overridden by connections that keep a
+    # session to the host open for as long as they're connected
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    # start using the session of another, already open connection
+    # to the same site (or open a new one if sessions can't be
+    # shared)
+    def share(self, connection):
+        self.open()
+
+    # another connection to the same site, to run operations in
+    # parallel. it uses the same wpsync dir, but doesn't remove it
+    # when it's done.
+    @contextmanager
+    def handle(self):
+        connection = type(self)(self.site)
+        connection.share(self)
+        connection.session.close()
+        connection.session = self.session
+        connection.agent_token = self.agent_token
+        connection.agent_libraries = self.agent_libraries
+        connection.agent_lock = self.agent_lock
+        connection.is_handle = True
+        try:
+            yield connection
+        finally:
+            connection.close()
+
     def make_wpsync_dir(self):
         # TODO better to ask forgiveness
         if not self.dir_exists(self.wpsync_dir):
             self.mkdir(self.wpsync_dir)
 
     def remove_wpsync_dir(self):
-        self.rmdir(self.wpsync_dir)
+        try:
+            self.rmdir(self.wpsync_dir)
+        finally:
+            self.session.close()
+            self.close()
 
     def cat_r(self, path, string):
         tmp_file = Path(NamedTemporaryFile().name)
@@ -55,35 +211,52 @@ class Connection:
         self.put(tmp_file, path)
         tmp_file.unlink()
 
-    def run_php(self, php_code):
-        path = self.normalise("run.php")
+    def url(self, name):
         url = self.site["file_url"]
         if url[-1] != "/":
             url += "/"
-        url += "wpsync/run.php"
-        self.cat_r(path, php_code)
+        return url + f"wpsync/{name}"
+
+    # all requests to the site go through one session with a pool
+    # of keep-alive connections, shared by the connection's handles
+    def make_session(self):
+        session = requests.Session()
         if "http_user" in self.site:
-            auth = (self.site["http_user"], self.site["http_pass"])
-        else:
-            auth = None
+            session.auth = (self.site["http_user"], self.site["http_pass"])
 
         # trust selfsigned certificate if exists, needed for SSL
         # connections to localhost
         if self.site["no_verify_ssl"]:
-            verify = False
+            session.verify = False
         elif (
             self.site["protocol"] == "file"
             and "_default_local_selfsigned_ca" in self.site
         ):
-            verify = self.site["_default_local_selfsigned_ca"]
-        else:
-            verify = None
+            session.verify = self.site["_default_local_selfsigned_ca"]
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.site["concurrency"]
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
-        r = requests.get(url, auth=auth, verify=verify)
-        if r.status_code != 200:
-            raise RemoteExecutionError(r.text.strip())
-        if "error" in r.text or "Error" in r.text or "ERROR" in r.text:
-            raise RemoteExecutionError(r.text.strip())
+    def run_php(self, php_code):
+        # every script gets a name of its own, so that connection
+        # handles can run php in parallel
+        name = f"run-{uuid4().hex}.php"
+        path = self.normalise(name)
+        self.cat_r(path, php_code)
+        lines = []
+        has_error = False
+        with self.session.get(self.url(name), stream=True) as r:
+            r.encoding = r.encoding or "utf-8"
+            for line in r.iter_lines(decode_unicode=True):
+                lines.append(line)
+                has_error = has_error or bool(RE_ERROR.search(line))
+        text = "\n".join(lines)
+        if r.status_code != 200 or has_error:
+            raise RemoteExecutionError(text.strip())
         # this makes replacing database urls fail on some PHP
         # versions because of an ambiguous continue in a switch
         # statement in the srdb tool
@@ -92,7 +265,103 @@ class Connection:
         # if "warning" in r.text or "Warning" in r.text or "WARNING" in r.text:
         #     raise RemoteExecutionError(r.text.strip())
         self.rm(path)
-        return r.text
+        return text
+
+    # the agent (agent.php) is uploaded once when we connect, with a
+    # token that is generated for this connection and has to come
+    # with every request
+    def upload_agent(self):
+        self.agent_token = uuid4().hex
+        config = agent_config_php_template.format(
+            token=php_string(self.agent_token),
+            mysql_host=php_string(self.site["mysql_host"]),
+            mysql_name=php_string(self.site["mysql_name"]),
+            mysql_user=php_string(self.site["mysql_user"]),
+            mysql_pass=php_string(self.site["mysql_pass"]),
+            mysql_port=int(self.site["mysql_port"]),
+        )
+        agent = (this_dir / "agent.php").read_text(encoding="utf-8")
+        self.cat_r(self.normalise("agent.php"), config + agent[len("<?php") :])
+
+    # connections that can run the native mysqldump and mysql clients
+    # on the server override this, and native_dump and native_import
+    def has_native_mysql(self):
+        return False
+
+    # the host and port at which the site's mysql server can be
+    # reached from here while the context lasts, or None if it can't
+    @contextmanager
+    def mysql_tunnel(self):
+        yield None
+
+    def upload_agent_libraries(self, operations):
+        with self.agent_lock:
+            for operation in operations:
+                for library in agent_libraries.get(operation["op"], []):
+                    if library not in self.agent_libraries:
+                        self.put(this_dir / library, self.normalise(library))
+                        self.agent_libraries.add(library)
+
+    @contextmanager
+    def agent_stream(self, operation):
+        """
+        Run an operation whose result is streamed as it is (a dump or
+        an archive) and yield the response as a file-like object.
+        """
+        self.upload_agent_libraries([operation])
+        with self.session.post(
+            self.url("agent.php"),
+            json={"token": self.agent_token, "stream": operation},
+            stream=True,
+        ) as r:
+            if r.status_code != 200:
+                raise RemoteExecutionError(
+                    f"agent.php: {r.status_code} {r.text.strip()}"
+                )
+            # undo the compression of the transfer
+            r.raw.decode_content = True
+            yield r.raw
+
+    def agent(self, operations, progress=None):
+        """
+        Run a batch of operations (dicts with an "op" and its
+        arguments, see agent.php) in one request and return their
+        results. The response is read as it arrives: progress is
+        called with what operations report while they run, and an
+        error is raised as soon as one fails.
+        """
+        self.upload_agent_libraries(operations)
+        results = []
+        other_lines = []
+        with self.session.post(
+            self.url("agent.php"),
+            json={"token": self.agent_token, "operations": operations},
+            stream=True,
+        ) as r:
+            if r.status_code != 200:
+                raise RemoteExecutionError(
+                    f"agent.php: {r.status_code} {r.text.strip()}"
+                )
+            r.encoding = "utf-8"
+            for line in r.iter_lines(decode_unicode=True):
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    # php warnings and notices, most probably
+                    other_lines.append(line)
+                    continue
+                if "progress" in response:
+                    if progress is not None:
+                        progress(response["progress"])
+                elif not response["ok"]:
+                    raise RemoteExecutionError(response["error"])
+                else:
+                    results.append(response["result"])
+        if len(results) < len(operations):
+            raise RemoteExecutionError(
+                "agent.php stopped early:\n" + "\n".join(other_lines)
+            )
+        return results
 
 
 class FileConnection(Connection):
@@ -117,19 +386,16 @@ class FileConnection(Connection):
     def put(self, local_path, remote_path):
         shutil.copyfile(local_path, remote_path)
 
-    def mirror(self, remote_path, local_path):
-        rsync(
-            "--recursive",
-            "--del",
-            "--compress",
-            remote_path + "/",
-            s(local_path),
-        )
+    def mirror(self, remote_path, local_path, link_dest=None):
+        args = ["--recursive", "--del", "--compress", "--times"]
+        args.extend(self.rsync_excludes(remote_path))
+        if link_dest is not None:
+            args.append(f"--link-dest={s(link_dest)}")
+        rsync(*args, remote_path + "/", s(local_path))
 
     def mirror_r(self, local_path, remote_path, exclude=[]):
         args = ["--recursive", "--del", "--compress"]
-        for pattern in exclude:
-            args.append(f"--exclude={quote(pattern)}")
+        args.extend(self.rsync_excludes(remote_path, exclude))
         args.extend([s(local_path) + "/", s(remote_path)])
         rsync(*args)
 
@@ -140,90 +406,369 @@ class FileConnection(Connection):
     def rm(self, path):
         os.remove(path)
 
+    @contextmanager
+    def mysql_tunnel(self):
+        yield self.site["mysql_host"], int(self.site["mysql_port"])
+
 
 class SSHConnection(Connection):
     def __init__(self, site):
         super().__init__(site)
         self.user = quote(site["user"])
         self.host = quote(site["host"])
+        self.control_dir = None
+        self.owns_master = False
+        self.native_mysql = None
+
+    # all ssh and rsync processes of a connection go through one
+    # multiplexed master session (see `man ssh_config`,
+    # ControlMaster), so we only pay for one handshake per site. if
+    # the master isn't running for some reason, ssh transparently
+    # falls back to opening a connection of its own.
+    @property
+    def control_path(self):
+        return os.path.join(self.control_dir, "master.sock")
+
+    def ssh_options(self):
+        if self.control_dir is None:
+            return []
+        return ["-o", "ControlMaster=no", "-S", self.control_path]
+
+    def rsync_options(self):
+        options = ["--compress"]
+        if self.control_dir is not None:
+            ssh_command = " ".join(["ssh", *map(quote, self.ssh_options())])
+            options.append(f"--rsh={ssh_command}")
+        if self.site["sudo_remote"]:
+            options.append("--rsync-path=sudo rsync")
+        return options
+
+    def open(self):
+        # the socket path must be short (unix sockets are limited to
+        # about 100 characters), so don't put it in the wpsyncdir
+        self.control_dir = mkdtemp(prefix="wpsync-")
+        process = run(
+            [
+                "ssh",
+                "-f",
+                "-N",
+                "-o",
+                "ControlMaster=yes",
+                "-S",
+                self.control_path,
+                f"{self.user}@{self.host}",
+            ]
+        )
+        if process.returncode != 0:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+        self.owns_master = self.control_dir is not None
+
+    def share(self, connection):
+        self.control_dir = connection.control_dir
+        self.native_mysql = connection.native_mysql
+
+    def close(self):
+        if not self.owns_master:
+            self.control_dir = None
+            return
+        run(
+            [
+                "ssh",
+                "-S",
+                self.control_path,
+                "-O",
+                "exit",
+                f"{self.user}@{self.host}",
+            ],
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        self.control_dir = None
+        self.owns_master = False
 
     def ssh_do(self, command):
         if self.site["sudo_remote"]:
             process = run(
-                ["ssh", "-t", f"{self.user}@{self.host}", "sudo " + command]
+                [
+                    "ssh",
+                    *self.ssh_options(),
+                    "-t",
+                    f"{self.user}@{self.host}",
+                    "sudo " + command,
+                ]
             )
         else:
-            process = run(["ssh", f"{self.user}@{self.host}", command])
+            process = run(
+                [
+                    "ssh",
+                    *self.ssh_options(),
+                    f"{self.user}@{self.host}",
+                    command,
+                ]
+            )
         return process
 
-    def dir_exists(self, path):
-        process = self.ssh_do(f"test -d {quote(s(path))}")
-        return process.returncode == 0
+    # the command to run a shell script on the server, whatever the
+    # login shell is
+    def ssh_command(self, script):
+        return [
+            "ssh",
+            *self.ssh_options(),
+            f"{self.user}@{self.host}",
+            "sh -c " + quote(script),
+        ]
 
-    def file_exists(self, path):
-        process = self.ssh_do(f"test -f {quote(s(path))}")
-        return process.returncode == 0
+    def has_native_mysql(self):
+        if self.native_mysql is None:
+            process = run(
+                self.ssh_command(
+                    "command -v mysqldump && command -v mysql"
+                    " && command -v gzip"
+                ),
+                stdout=PIPE,
+                stderr=PIPE,
+            )
+            self.native_mysql = process.returncode == 0
+        return self.native_mysql
 
-    def mkdir(self, path):
-        self.ssh_do(f"mkdir {quote(s(path))}")
+    # a local port forwarded to the mysql server (as the server sees
+    # it). if that doesn't work, the caller does without
+    @contextmanager
+    def mysql_tunnel(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        mysql = f'{self.site["mysql_host"]}:{self.site["mysql_port"]}'
+        address = None
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(self.forward_port(port, mysql))
+                address = "127.0.0.1", port
+            except RemoteExecutionError as error:
+                put.warn(f"Can't forward a port to mysql at {mysql}: {error}")
+            yield address
+
+    # forward a local port to an address as the server sees it while
+    # the context lasts, through the master connection if there is
+    # one (so there's no second login), or else an ssh of its own
+    @contextmanager
+    def forward_port(self, port, address):
+        forward = ["-L", f"127.0.0.1:{port}:{address}"]
+        target = f"{self.user}@{self.host}"
+        if self.control_dir is not None:
+            control = ["ssh", "-S", self.control_path]
+            process = run(
+                [*control, "-O", "forward", *forward, target],
+                stdout=DEVNULL,
+                stderr=PIPE,
+            )
+            if process.returncode != 0:
+                raise RemoteExecutionError(
+                    process.stderr.decode("utf-8", errors="replace").strip()
+                )
+            try:
+                yield
+            finally:
+                run(
+                    [*control, "-O", "cancel", *forward, target],
+                    stdout=DEVNULL,
+                    stderr=DEVNULL,
+                )
+            return
+
+        process = Popen(
+            [
+                "ssh",
+                "-N",
+                "-o",
+                "ExitOnForwardFailure=yes",
+                *forward,
+                target,
+            ],
+            stdout=DEVNULL,
+            stderr=PIPE,
+        )
+        try:
+            # wait until the forward is up
+            for i in range(100):
+                if process.poll() is not None:
+                    raise RemoteExecutionError(
+                        process.stderr.read().decode("utf-8").strip()
+                    )
+                try:
+                    socket.create_connection(("127.0.0.1", port), 1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                raise RemoteExecutionError("Forwarding the port timed out")
+            yield
+        finally:
+            process.terminate()
+            process.wait()
+
+    # the credentials are given to the clients in an option file that
+    # only exists while they run, so they don't show up on any command
+    # line. the file's content is sent first on stdin, ahead of
+    # whatever else the command reads from there
+    def mysql_script(self, command):
+        options = "[client]\n"
+        for option, key in [
+            ("host", "mysql_host"),
+            ("port", "mysql_port"),
+            ("user", "mysql_user"),
+            ("password", "mysql_pass"),
+        ]:
+            value = self.site[key].replace("\\", "\\\\").replace('"', '\\"')
+            options += f'{option}="{value}"\n'
+        options = options.encode("utf-8")
+        script = (
+            "umask 077\n"
+            "f=$(mktemp) || exit 1\n"
+            "trap 'rm -f \"$f\"' EXIT\n"
+            f'dd bs=1 count={len(options)} of="$f" 2>/dev/null\n'
+            f"{command}\n"
+        )
+        return script, options
+
+    # dump the database with mysqldump into the open binary file f,
+    # as it is written. takes the same parameters as the agent's dump
+    # operation. the dump is always gzipped for the transfer, and
+    # decompressed here if the backup is to be plain
+    def native_dump(self, dump_operation, f):
+        # sh has no pipefail: if mysqldump fails, the option file is
+        # removed so the script doesn't exit with gzip's status
+        command = (
+            '{ mysqldump --defaults-extra-file="$f" --single-transaction'
+            " --quick --add-drop-table --extended-insert --no-tablespaces"
+            " --default-character-set=utf8mb4"
+            f' --net-buffer-length={int(dump_operation["net_buffer_length"])}'
+            f' {quote(self.site["mysql_name"])} || rm -f "$f"; }}'
+            ' | gzip && test -e "$f"'
+        )
+        script, options = self.mysql_script(command)
+        decompress = None
+        if dump_operation["compress"] != "Gzip":
+            decompress = zlib.decompressobj(wbits=31)
+        with TemporaryFile() as errors:
+            process = Popen(
+                self.ssh_command(script),
+                stdin=PIPE,
+                stdout=PIPE,
+                stderr=errors,
+            )
+            try:
+                process.stdin.write(options)
+                process.stdin.close()
+                while True:
+                    chunk = process.stdout.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    if decompress is not None:
+                        chunk = decompress.decompress(chunk)
+                    f.write(chunk)
+                if decompress is not None:
+                    f.write(decompress.flush())
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            process.wait()
+            if process.returncode != 0:
+                errors.seek(0)
+                raise RemoteExecutionError(
+                    errors.read().decode("utf-8", errors="replace").strip()
+                )
+
+    # import a local dump (plain or gzipped) with mysql, streaming it
+    # to the server as it is read
+    def native_import(self, dump_file):
+        command = (
+            'gzip -dcf | mysql --defaults-extra-file="$f"'
+            ' --init-command="SET SESSION FOREIGN_KEY_CHECKS = 0"'
+            f' {quote(self.site["mysql_name"])}'
+        )
+        script, options = self.mysql_script(command)
+        with TemporaryFile() as output:
+            process = Popen(
+                self.ssh_command(script),
+                stdin=PIPE,
+                stdout=output,
+                stderr=STDOUT,
+            )
+            try:
+                process.stdin.write(options)
+                with open(dump_file, "rb") as f:
+                    shutil.copyfileobj(f, process.stdin, 1024 * 1024)
+                process.stdin.close()
+            except BrokenPipeError:
+                # mysql gave up, what went wrong is in the output
+                pass
+            process.wait()
+            if process.returncode != 0:
+                output.seek(0)
+                raise RemoteExecutionError(
+                    output.read().decode("utf-8", errors="replace").strip()
+                )
+
+    def chown(self, path, recursive=False):
+        flags = "-R " if recursive else ""
         if "chown_remote" in self.site and "chgrp_remote" in self.site:
             owner = self.site["chown_remote"]
             group = self.site["chgrp_remote"]
             self.ssh_do(
-                f"chown {quote(owner)}:{quote(group)} {quote(s(path))}"
+                f"chown {flags}{quote(owner)}:{quote(group)} {quote(s(path))}"
             )
         elif "chown_remote" in self.site:
             owner = self.site["chown_remote"]
-            self.ssh_do(f"chown {quote(owner)} {quote(s(path))}")
+            self.ssh_do(f"chown {flags}{quote(owner)} {quote(s(path))}")
         elif "chgrp_remote" in self.site:
             group = self.site["chgrp_remote"]
-            self.ssh_do(f"chgrp {quote(group)} {quote(s(path))}")
+            self.ssh_do(f"chgrp {flags}{quote(group)} {quote(s(path))}")
+
+    def dir_exists(self, path):
+        process = self.ssh_do(f"test -d {quote(s(path))}")
+        return process.returncode == 0
+
+    def file_exists(self, path):
+        process = self.ssh_do(f"test -f {quote(s(path))}")
+        return process.returncode == 0
+
+    def mkdir(self, path):
+        self.ssh_do(f"mkdir {quote(s(path))}")
+        self.chown(path)
 
     def rmdir(self, path):
         self.ssh_do(f"rm -r {quote(s(path))}")
 
     def get(self, remote_path, local_path):
-        options = ["--compress"]
-        if self.site["sudo_remote"]:
-            options.append("--rsync-path=sudo rsync")
         run(
             [
                 "rsync",
-                *options,
+                *self.rsync_options(),
                 f"{self.user}@{self.host}:{quote(s(remote_path))}",
                 s(local_path),
             ]
         )
 
     def put(self, local_path, remote_path):
-        options = ["--compress"]
-        if self.site["sudo_remote"]:
-            options.append("--rsync-path=sudo rsync")
         run(
             [
                 "rsync",
-                *options,
+                *self.rsync_options(),
                 s(local_path),
                 f"{self.user}@{self.host}:{quote(s(remote_path))}",
             ]
         )
-        if "chown_remote" in self.site and "chgrp_remote" in self.site:
-            owner = self.site["chown_remote"]
-            group = self.site["chgrp_remote"]
-            self.ssh_do(
-                f"chown {quote(owner)}:{quote(group)} {quote(s(remote_path))}"
-            )
-        elif "chown_remote" in self.site:
-            owner = self.site["chown_remote"]
-            self.ssh_do(f"chown {quote(owner)} {quote(s(remote_path))}")
-        elif "chgrp_remote" in self.site:
-            group = self.site["chgrp_remote"]
-            self.ssh_do(f"chgrp {quote(group)} {quote(s(remote_path))}")
+        self.chown(remote_path)
 
-    def mirror(self, remote_path, local_path):
-        options = ["--recursive", "--del", "--compress"]
-        if self.site["sudo_remote"]:
-            options.append("--rsync-path=sudo rsync")
+    def mirror(self, remote_path, local_path, link_dest=None):
+        options = ["--recursive", "--del", "--times", *self.rsync_options()]
+        options.extend(self.rsync_excludes(remote_path))
+        if link_dest is not None:
+            options.append(f"--link-dest={s(link_dest)}")
         run(
             [
                 "rsync",
@@ -234,26 +779,12 @@ class SSHConnection(Connection):
         )
 
     def mirror_r(self, local_path, remote_path, exclude=[]):
-        args = ["--recursive", "--del", "--compress"]
-        for pattern in exclude:
-            args.append(f"--exclude={quote(pattern)}")
-        if self.site["sudo_remote"]:
-            args.append("--rsync-path=sudo rsync")
+        args = ["--recursive", "--del", *self.rsync_options()]
+        args.extend(self.rsync_excludes(remote_path, exclude))
         args.append(s(local_path) + "/")
         args.append(f"{self.user}@{self.host}:{quote(s(remote_path))}")
         run(["rsync", *args])
-        if "chown_remote" in self.site and "chgrp_remote" in self.site:
-            owner = self.site["chown_remote"]
-            group = self.site["chgrp_remote"]
-            self.ssh_do(
-                f"chown -R {quote(owner)}:{quote(group)} {quote(s(path))}"
-            )
-        elif "chown_remote" in self.site:
-            owner = self.site["chown_remote"]
-            self.ssh_do(f"chown -R {quote(owner)} {quote(s(path))}")
-        elif "chgrp_remote" in self.site:
-            group = self.site["chgrp_remote"]
-            self.ssh_do(f"chgrp -R {quote(group)} {quote(s(path))}")
+        self.chown(remote_path, recursive=True)
 
     def cat(self, path):
         return self.ssh_do(f"cat {quote(s(path))}")
@@ -271,20 +802,74 @@ class FTPConnection(Connection):
             self.host = quote("sftp://" + site["host"])
         else:
             self.host = quote(site["host"])
+        self.process = None
 
-    def lftp(self, command, capture=False):
-        completed_process = run(
-            [
-                "lftp",
-                "-c",
-                f"open -u {self.user},{self.pasw} {self.host}; {command}; quit",
-            ],
-            stdout=PIPE,
-            stderr=PIPE,
-        )
-        if completed_process.stdout:
-            return completed_process.stdout.decode("utf8")
-        return ""
+    # instead of running `lftp -c` (and logging in) for every
+    # command, one lftp process is kept open for as long as we're
+    # connected and fed commands on stdin. every command is
+    # followed by an echo of a marker that tells us that it has
+    # finished and whether it succeeded.
+    def open(self):
+        self.process = Popen(["lftp"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self.stderr_lines = []
+        self.command_count = 0
+        self.lock = Lock()
+        stderr_reader = Thread(target=self._read_stderr, daemon=True)
+        stderr_reader.start()
+        self.lftp("set xfer:use-temp-file yes")
+        self.lftp(f"open -u {self.user},{self.pasw} {self.host}")
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.close()
+            self.process.wait(timeout=30)
+        except (OSError, TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr_lines.append(line.decode("utf8", errors="replace"))
+
+    def lftp(self, command, capture=False, check=False):
+        if self.process is None:
+            raise RemoteExecutionError("lftp session is not open")
+        with self.lock:
+            self.command_count += 1
+            marker = f"__wpsync_done_{self.command_count}__"
+            del self.stderr_lines[:]
+            self.process.stdin.write(
+                f"{command} && echo {marker}0 || echo {marker}1\n".encode(
+                    "utf8"
+                )
+            )
+            self.process.stdin.flush()
+            output = []
+            status = None
+            for line in self.process.stdout:
+                line = line.decode("utf8", errors="replace")
+                index = line.rfind(marker)
+                if index != -1 and line[index:].rstrip() in [
+                    marker + "0",
+                    marker + "1",
+                ]:
+                    output.append(line[:index])
+                    status = int(line[index + len(marker)])
+                    break
+                output.append(line)
+            if status is None:
+                raise RemoteExecutionError(
+                    "lftp exited unexpectedly\n" + "".join(self.stderr_lines)
+                )
+            if status != 0 and check:
+                message = "".join(self.stderr_lines).strip()
+                if not message:
+                    message = f"lftp: {command} failed"
+                raise RemoteExecutionError(message)
+            return "".join(output)
 
     def dir_exists(self, path):
         path = path[:-1] + "[" + path[-1] + "]"
@@ -307,22 +892,204 @@ class FTPConnection(Connection):
         self.lftp(f"rm -r {quote(s(path))}")
 
     def get(self, remote_path, local_path):
-        self.lftp(f"get {quote(s(remote_path))} -o {quote(s(local_path))}")
+        self.lftp(
+            f"get {quote(s(remote_path))} -o {quote(s(local_path))}",
+            check=True,
+        )
 
     def put(self, local_path, remote_path):
-        self.lftp(f"put {quote(s(local_path))} -o {quote(s(remote_path))}")
+        self.lftp(
+            f"put {quote(s(local_path))} -o {quote(s(remote_path))}",
+            check=True,
+        )
 
-    def mirror(self, remote_path, local_path):
-        cmd = "mirror --delete"
+    def mirror(self, remote_path, local_path, link_dest=None):
+        # lftp has no --link-dest, so we start from hard links to
+        # the previous backup and only fetch what has changed.
+        # xfer:use-temp-file (set in open) makes lftp replace changed
+        # files instead of writing into them, so the previous backup
+        # isn't touched.
+        if link_dest is not None:
+            link_tree(link_dest, local_path)
+        # listing a big tree over ftp takes ages, so what has changed
+        # is found with a manifest from the agent if it can make one
+        try:
+            manifest = self.remote_manifest(remote_path)
+        except RemoteExecutionError:
+            manifest = None
+        if manifest is not None:
+            self.mirror_changes(manifest, remote_path, local_path)
+            return
+        cmd = "mirror --delete" + self.lftp_excludes(remote_path)
         self.lftp(f"{cmd} {quote(s(remote_path))} {quote(s(local_path))}")
 
+    # paths in agent operations are relative to the base dir. None
+    # for paths outside of it
+    def site_path(self, remote_path):
+        base_dir = self.site["base_dir"]
+        path = s(remote_path) + "/"
+        if not path.startswith(base_dir):
+            return None
+        return path[len(base_dir) :].rstrip("/")
+
+    def remote_manifest(self, remote_path):
+        path = self.site_path(remote_path)
+        if path is None:
+            return None
+        [manifest] = self.agent([{"op": "manifest", "path": path}])
+        return manifest
+
+    # make local_path (empty, or a copy of the previous backup) look
+    # like the remote tree in the manifest
+    def mirror_changes(self, manifest, remote_path, local_path):
+        local_path = Path(local_path)
+        local_files, local_dirs = local_manifest(local_path)
+        remote_files = {
+            path: (size, mtime) for path, size, mtime in manifest["files"]
+        }
+        remote_dirs = set(manifest["dirs"])
+
+        for path in sorted(local_dirs - remote_dirs, reverse=True):
+            shutil.rmtree(local_path / path, ignore_errors=True)
+        for path in local_files.keys() - remote_files.keys():
+            if (local_path / path).is_file():
+                (local_path / path).unlink()
+        for path in sorted(remote_dirs):
+            (local_path / path).mkdir(mode=0o755, parents=True, exist_ok=True)
+
+        changed = sorted(
+            path
+            for path, stat in remote_files.items()
+            if local_files.get(path) != stat
+        )
+        for path in changed:
+            if (local_path / path).is_file():
+                (local_path / path).unlink()
+        if not changed:
+            return
+        received = self.get_packed(remote_path, local_path, changed)
+        missing = [path for path in changed if path not in received]
+        self.get_files(remote_path, local_path, missing, remote_files)
+
+    # fetch files in one archive that the agent packs on the fly,
+    # instead of one by one over ftp. returns the files that arrived
+    def get_packed(self, remote_path, local_path, files):
+        wanted = set(files)
+        received = set()
+        operation = {
+            "op": "pack",
+            "path": self.site_path(remote_path),
+            "files": files,
+        }
+        try:
+            with self.agent_stream(operation) as response:
+                with tarfile.open(fileobj=response, mode="r|") as archive:
+                    for member in archive:
+                        if member.isfile() and member.name in wanted:
+                            archive.extract(member, s(local_path))
+                            received.add(member.name)
+        except (
+            RemoteExecutionError,
+            requests.RequestException,
+            urllib3.exceptions.HTTPError,
+            tarfile.TarError,
+        ) as error:
+            # what's missing is fetched over ftp
+            put.warn(f"Archive download failed, using ftp: {error}")
+        return received
+
+    def get_files(self, remote_path, local_path, files, remote_files):
+        # several files per get, so it's one command per batch
+        for i in range(0, len(files), 100):
+            batch = [
+                f"{quote(s(remote_path) + '/' + path)}"
+                f" -o {quote(s(local_path / path))}"
+                for path in files[i : i + 100]
+            ]
+            self.lftp("get " + " ".join(batch), check=True)
+        # with the times from the server, the files compare equal to
+        # the next manifest
+        for path in files:
+            mtime = remote_files[path][1]
+            os.utime(local_path / path, (mtime, mtime))
+
     def mirror_r(self, local_path, remote_path, exclude=[]):
-        cmd = "mirror --delete -R"
-        for pattern in exclude:
-            cmd += f" --exclude {quote(pattern)}"
+        # uploading many small files over ftp takes ages, so if the
+        # server can unzip, what differs is uploaded as one zip
+        path = self.site_path(remote_path)
+        if path is not None:
+            try:
+                manifest, has_zip = self.agent(
+                    [
+                        {"op": "manifest", "path": path},
+                        {"op": "has_extension", "name": "zip"},
+                    ]
+                )
+            except RemoteExecutionError:
+                has_zip = False
+            if has_zip:
+                self.put_changes(manifest, local_path, remote_path, exclude)
+                return
+        cmd = "mirror --delete -R" + self.lftp_excludes(remote_path, exclude)
         cmd += f" {quote(s(local_path))} {quote(s(remote_path))}"
         self.lftp(cmd)
 
+    # make the remote tree in the manifest look like local_path. files
+    # and directories that match a pattern in exclude (by name or by
+    # relative path) are neither uploaded nor deleted
+    def put_changes(self, manifest, local_path, remote_path, exclude):
+        local_path = Path(local_path)
+        local_files, local_dirs = local_manifest(local_path)
+        remote_files = {
+            path: (size, mtime) for path, size, mtime in manifest["files"]
+        }
+        remote_dirs = set(manifest["dirs"])
+        # the manifest doesn't list the wpsync dir
+        wpsync_dir = self.wpsync_dir_in(remote_path)
+
+        def included(path):
+            if wpsync_dir is not None and (
+                path == wpsync_dir or path.startswith(wpsync_dir + "/")
+            ):
+                return False
+            return not any(
+                fnmatch(name, pattern)
+                for name in [path, *path.split("/")]
+                for pattern in exclude
+            )
+
+        changed = sorted(
+            path
+            for path, stat in local_files.items()
+            if remote_files.get(path) != stat and included(path)
+        )
+        new_dirs = sorted(filter(included, local_dirs - remote_dirs))
+        gone = (remote_files.keys() - local_files.keys()) | (
+            remote_dirs - local_dirs
+        )
+        delete = sorted(filter(included, gone))
+        if not changed and not new_dirs and not delete:
+            return
+
+        archive_name = f"{uuid4().hex}.zip"
+        with TemporaryDirectory() as temp_dir:
+            archive = Path(temp_dir) / archive_name
+            with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+                for path in new_dirs + changed:
+                    zf.write(local_path / path, path)
+            self.put(archive, self.normalise(archive_name))
+        self.agent(
+            [
+                {
+                    "op": "unpack",
+                    "path": self.site_path(remote_path),
+                    "archive": archive_name,
+                    "mtimes": {path: local_files[path][1] for path in changed},
+                    "delete": delete,
+                }
+            ]
+        )
+
     def cat(self, path):
         return self.lftp(f"cat {quote(s(path))}", capture=True)
 
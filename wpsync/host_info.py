@@ -1,13 +1,21 @@
 import json
 import sqlparse
 from .persistent_dict import PersistentDict
+from .sql_dump import (
+    MANIFEST_FILE_NAME,
+    find_dump,
+    load_index,
+    read_each_range,
+    read_manifest,
+)
 
 
 class HostInfo(PersistentDict):
     """
     HostInfo is just a PersistentDict, except that it has some
     magic items that may be retrieved without having been set
-    (only "database_settings", at the moment)
+    (only "database_settings", at the moment, which is parsed from
+    the newest database backup and cached until there's a newer one)
     """
 
     def __init__(self, wpsyncdir, site, connection):
@@ -18,14 +26,9 @@ class HostInfo(PersistentDict):
         super().__init__(wpsyncdir / "info" / filename)
 
     def __getitem__(self, key):
-        try:
-            return super().__getitem__(key)
-        except KeyError as key_error:
-            if key == "database_settings":
-                self._get_database_settings()
-                return self["database_settings"]
-            else:
-                raise key_error
+        if key == "database_settings":
+            return self._get_database_settings()
+        return super().__getitem__(key)
 
     def _get_database_settings(self):
         site_backup_dir = self.wpsyncdir / "backups" / self.site["fs_safe_name"]
@@ -35,36 +38,65 @@ class HostInfo(PersistentDict):
         backups = sorted(site_backup_dir.iterdir())
         backups.reverse()
         for backup in backups:
-            backup_db_file = backup / "database" / "dump.sql"
-            if backup_db_file.is_file():
+            database_dir = backup / "database"
+            if (database_dir / MANIFEST_FILE_NAME).is_file():
+                last_database_backup = database_dir / MANIFEST_FILE_NAME
+                break
+            backup_db_file = find_dump(database_dir)
+            if backup_db_file:
                 last_database_backup = backup_db_file
                 break
         if not last_database_backup:
             raise RuntimeError("No database backup to parse settings from")
-        self["database_settings"] = self._parse_database_settings(
-            last_database_backup
-        )
 
-    def _parse_database_settings(self, dump_file):
+        # the settings are cached together with the identity of the
+        # dump they were parsed from, so we only have to look at a
+        # dump again when there's a newer one
+        stat = last_database_backup.stat()
+        source = {
+            "path": str(last_database_backup),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        cached = self.get("database_settings")
+        cached_source = self.get("database_settings_source")
+        if cached is not None and cached_source == source:
+            return cached
+        if last_database_backup.name == MANIFEST_FILE_NAME:
+            manifest = read_manifest(last_database_backup.parent)
+            create_statements = [t["create"] for t in manifest["tables"]]
+            settings = self._parse_database_settings(create_statements)
+        else:
+            index = load_index(last_database_backup)
+            ranges = [
+                t["create"] for t in index["tables"].values() if t["create"]
+            ]
+            settings = self._parse_database_settings(
+                statement.decode("utf-8")
+                for statement in read_each_range(last_database_backup, ranges)
+            )
+        self["database_settings"] = settings
+        self["database_settings_source"] = source
+        return settings
+
+    # create_statements may be lazy: we stop consuming them (and so
+    # stop reading the dump) as soon as we have found everything
+    def _parse_database_settings(self, create_statements):
         to_find = ["CHARSET", "COLLATE", "ENGINE"]
-        db_dump = dump_file.read_text(encoding="utf-8")
-        statements = sqlparse.parse(db_dump)
         detected_keyword = None
         settings = {}
-        for statement in statements:
-
-            # only look at CREATE statements to find stuff
-            if statement.token_first().value == "CREATE":
-                for token in statement.flatten():
-                    if token.value in to_find:
-                        detected_keyword = token.value
-                    elif (
-                        detected_keyword
-                        and token.ttype == sqlparse.tokens.Token.Name
-                    ):
-                        settings[detected_keyword] = token.value
-                        to_find.remove(detected_keyword)
-                        if len(to_find) == 0:
-                            return settings
-                        detected_keyword = None
+        for create_statement in create_statements:
+            parsed = sqlparse.parse(create_statement)
+            for token in (t for s in parsed for t in s.flatten()):
+                if token.value in to_find:
+                    detected_keyword = token.value
+                elif (
+                    detected_keyword
+                    and token.ttype == sqlparse.tokens.Token.Name
+                ):
+                    settings[detected_keyword] = token.value
+                    to_find.remove(detected_keyword)
+                    if len(to_find) == 0:
+                        return settings
+                    detected_keyword = None
         return settings
@@ -1,9 +1,158 @@
-<?php	  
-// EXAMPLE: IMPORT_TABLES("localhost","user","pass","db_name", "my_baseeee.sql"); //TABLES WILL BE OVERWRITTEN
-// P.S. IMPORTANT NOTE for people who try to change/replace some strings in SQL FILE before importing, MUST READ: https://goo.gl/2fZDQL
+<?php
+// Imports an SQL dump (as written by Mysqldump.php) into a MySQL
+// database. Loosely based on IMPORT_TABLES from
+// https://github.com/tazotodua/useful-php-scripts
+//
+// Statements are split by a reader that knows about quoted strings
+// and comments, so neither multi-row INSERTs nor semicolons and
+// newlines inside values are a problem. Each table's rows are
+// inserted in one transaction with unique and foreign key checks
+// disabled.
+//
+// An import can be split into chunks that each run in their own
+// request: IMPORT_TABLES starts at a byte offset and stops after a
+// number of seconds, at the end of a statement, and prints the
+// offset to continue from ("WPSYNC_OFFSET <n>"), or "WPSYNC_DONE".
 
-// https://github.com/tazotodua/useful-php-scripts 
-function IMPORT_TABLES($host,$user,$pass,$dbname,$port, $sql_file_path) {
+class WPSYNC_SQL_READER {
+    const CHUNK_SIZE = 1048576;
+
+    private $handle;
+    private $buffer = '';
+    private $start = 0;
+    private $eof = false;
+    // offset in the dump of the start of the buffer
+    private $base;
+
+    public function __construct($handle, $offset = 0) {
+        $this->handle = $handle;
+        $this->base = $offset;
+    }
+
+    // offset in the dump right after the last statement returned
+    public function offset() {
+        return $this->base + $this->start;
+    }
+
+    // read another chunk into the buffer, dropping everything
+    // before the statement that is currently being read
+    private function fill() {
+        if ($this->eof) {
+            return false;
+        }
+        $chunk = fread($this->handle, self::CHUNK_SIZE);
+        if ($chunk === false || $chunk === '') {
+            $this->eof = true;
+            return false;
+        }
+        if ($this->start > 0) {
+            $this->buffer = substr($this->buffer, $this->start);
+            $this->base += $this->start;
+            $this->start = 0;
+        }
+        $this->buffer .= $chunk;
+        return true;
+    }
+
+    // returns the next statement (without the terminating ;), or
+    // null at the end of the dump
+    public function next() {
+        $i = $this->start;
+        $quote = null;
+        while (true) {
+            $length = strlen($this->buffer);
+
+            // make sure there's always a character to look ahead
+            if ($i + 1 >= $length) {
+                $offset = $i - $this->start;
+                if ($this->fill()) {
+                    $i = $this->start + $offset;
+                    continue;
+                }
+                if ($i >= $length) {
+                    break;
+                }
+            }
+
+            if ($quote !== null) {
+                $i += strcspn($this->buffer, $quote . '\\', $i);
+                if ($i >= $length) {
+                    continue;
+                }
+                if ($this->buffer[$i] === '\\' && $quote !== '`') {
+                    $i += 2;
+                    continue;
+                }
+                if ($this->buffer[$i] === $quote) {
+                    $quote = null;
+                }
+                $i++;
+                continue;
+            }
+
+            $i += strcspn($this->buffer, "'\"`;-#/", $i);
+            if ($i >= $length || ($i + 1 >= $length && !$this->eof)) {
+                continue;
+            }
+            $char = $this->buffer[$i];
+            $next = $i + 1 < $length ? $this->buffer[$i + 1] : '';
+
+            if ($char === ';') {
+                $statement = substr($this->buffer, $this->start, $i - $this->start);
+                $this->start = $i + 1;
+                if (self::is_empty($statement)) {
+                    $i = $this->start;
+                    continue;
+                }
+                return $statement;
+            } elseif ($char === "'" || $char === '"' || $char === '`') {
+                $quote = $char;
+                $i++;
+            } elseif ($char === '#' || ($char === '-' && $next === '-')) {
+                $at_start = trim(substr($this->buffer, $this->start, $i - $this->start)) === '';
+                $i = $this->skip_to("\n", $i);
+                // comments in front of a statement are dropped
+                if ($at_start) {
+                    $this->start = $i;
+                }
+            } elseif ($char === '/' && $next === '*') {
+                $i = $this->skip_to('*/', $i + 2);
+            } else {
+                $i++;
+            }
+        }
+
+        $statement = substr($this->buffer, $this->start);
+        $this->start = strlen($this->buffer);
+        if (self::is_empty($statement)) {
+            return null;
+        }
+        return $statement;
+    }
+
+    // returns the position after the next $needle, reading more of
+    // the dump if necessary
+    private function skip_to($needle, $i) {
+        while (true) {
+            $found = strpos($this->buffer, $needle, $i);
+            if ($found !== false) {
+                return $found + strlen($needle);
+            }
+            $offset = $i - $this->start;
+            if (!$this->fill()) {
+                return strlen($this->buffer);
+            }
+            $i = $this->start + $offset;
+        }
+    }
+
+    private static function is_empty($statement) {
+        $statement = preg_replace('/^\s*(--[^\n]*|#[^\n]*)$/m', '', $statement);
+        return trim($statement) === '';
+    }
+}
+
+function IMPORT_TABLES($host, $user, $pass, $dbname, $port, $sql_file_path, $offset = 0, $max_seconds = 0) {
     set_time_limit(3000);
     $handle = fopen($sql_file_path, 'r');
 
@@ -19,18 +168,65 @@ function IMPORT_TABLES($host,$user,$pass,$dbname,$port, $sql_file_path) {
     }
 
     $mysqli->query("SET NAMES 'utf8'");
-    $templine = '';	// Temporary variable, used to store current query
-
-    while (($line = fgets($handle)) !== false) {
-        if (substr($line, 0, 2) != '--' && $line != '') {
-            $templine .= $line; // (if it is not a comment..) Add this line to the current segment
-            if (substr(trim($line), -1, 1) == ';') { // If it has a semicolon at the end, it's the end of the query
-                if (!$mysqli->query($templine)) {
-                    print('Error performing query \'<strong>' . $templine . '\': ' . $mysqli->error . '<br /><br />' . "\n");
-                }
-                $templine = ''; // set variable to empty, to start picking up the lines after ";"
+
+    // when resuming, the session settings from the head of the dump
+    // (character set, time zone, sql mode ...) have to be applied
+    // again before we go on where the last chunk stopped
+    if ($offset > 0) {
+        $reader = new WPSYNC_SQL_READER($handle);
+        while (($statement = $reader->next()) !== null) {
+            if (!preg_match('/^\s*(\/\*!\d+\s+)?SET\s/i', $statement)) {
+                break;
             }
+            $mysqli->query($statement);
+        }
+        fclose($handle);
+        $handle = fopen($sql_file_path, 'r');
+        fseek($handle, $offset);
+    }
+
+    $mysqli->query('SET FOREIGN_KEY_CHECKS = 0');
+    $mysqli->query('SET UNIQUE_CHECKS = 0');
+    $mysqli->query('SET AUTOCOMMIT = 0');
+
+    // the time budget is for the statements only, not for getting
+    // to the offset (which, in a compressed dump, means inflating
+    // everything before it)
+    $started = microtime(true);
+    $reader = new WPSYNC_SQL_READER($handle, $offset);
+    $table = null;
+    $done = true;
+    while (($statement = $reader->next()) !== null) {
+
+        // all INSERTs into a table run in one transaction, which is
+        // committed as soon as something else comes along
+        $inserting_into = null;
+        if (preg_match('/^\s*INSERT\s+INTO\s+`([^`]+)`/i', $statement, $match)) {
+            $inserting_into = $match[1];
+        }
+        if ($table !== null && $inserting_into !== $table) {
+            $mysqli->query('COMMIT');
         }
+        $table = $inserting_into;
+
+        if (!$mysqli->query($statement)) {
+            print('Error performing query \'<strong>' . substr($statement, 0, 300) . '\': ' . $mysqli->error . '<br /><br />' . "\n");
+        }
+
+        if ($max_seconds > 0 && microtime(true) - $started > $max_seconds) {
+            $done = false;
+            break;
+        }
+    }
+    $mysqli->query('COMMIT');
+    $mysqli->query('SET UNIQUE_CHECKS = 1');
+    $mysqli->query('SET FOREIGN_KEY_CHECKS = 1');
+    fclose($handle);
+
+    // everything up to here is committed
+    if ($done) {
+        echo "WPSYNC_DONE\n";
+    } else {
+        echo 'WPSYNC_OFFSET ' . $reader->offset() . "\n";
     }
-    return 'Importing finished. Now, Delete the import file.';
 }
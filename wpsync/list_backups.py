@@ -1,8 +1,16 @@
 from . import put
+from .sql_dump import find_dump, load_index, read_manifest
 
 
 def list_backups(
-    wpsyncdir, site_names, database, uploads, plugins, themes, full
+    wpsyncdir,
+    site_names,
+    database,
+    uploads,
+    plugins,
+    themes,
+    full,
+    tables=None,
 ):
     is_single = len(site_names) == 1
     backup_dir = wpsyncdir / "backups"
@@ -29,6 +37,27 @@ def list_backups(
                     do_list = do_list and "full" in details
                 if do_list:
                     print(backup_title)
+                    if tables:
+                        list_tables(backup_path / "database", tables)
         except FileNotFoundError as e:
             if is_single:
                 put.error(f"There are no backups for {site_name}.")
+
+
+# the row counts come from the manifest or the index of the dump, so
+# the dump itself doesn't have to be read
+def list_tables(database_dir, tables):
+    manifest = read_manifest(database_dir)
+    if manifest:
+        rows = {t["name"]: t["rows"] for t in manifest["tables"]}
+    else:
+        dump_file = find_dump(database_dir)
+        if not dump_file:
+            return
+        index = load_index(dump_file)
+        rows = {name: t["rows"] for name, t in index["tables"].items()}
+    for table in tables:
+        if table in rows:
+            print(f"  {table}: {rows[table]} rows")
+        else:
+            print(f"  {table}: not in this backup")
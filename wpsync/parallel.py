@@ -0,0 +1,70 @@
+import contextvars
+from contextlib import ExitStack
+from queue import Empty, Queue
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+
+def run_parallel(tasks, max_workers):
+    """
+    Run the callables in tasks on at most max_workers threads and
+    return their results in the same order. Every task runs in a
+    copy of the caller's context, so e.g. put.prefix carries over.
+    If a task raises, the tasks that haven't started yet are
+    cancelled and the exception is re-raised once the running ones
+    have finished.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, task)
+            for task in tasks
+        ]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+    for future in futures:
+        if not future.cancelled() and future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
+
+
+def run_on_handles(connection, tasks, max_workers):
+    """
+    Run tasks (callables taking a connection) in parallel on at most
+    max_workers handles of connection, which are opened once and
+    take the tasks one after the other. Results come back in the
+    order of tasks. With max_workers == 1 the tasks simply run one
+    after the other on connection itself, and so they do if
+    connection is a handle already: it's part of a pool that is
+    bounded by max_workers, and pools mustn't multiply.
+    """
+    if max_workers == 1 or len(tasks) == 1 or connection.is_handle:
+        return [task(connection) for task in tasks]
+
+    pending = Queue()
+    for i, task in enumerate(tasks):
+        pending.put((i, task))
+    results = [None] * len(tasks)
+    failed = Event()
+
+    # every worker opens a handle (logging in again, for ftp), so a
+    # handle isn't opened for nothing if there's no task left for it
+    def worker():
+        with ExitStack() as stack:
+            handle = None
+            while not failed.is_set():
+                try:
+                    i, task = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    if handle is None:
+                        handle = stack.enter_context(connection.handle())
+                    results[i] = task(handle)
+                except BaseException:
+                    # the other workers don't start any more tasks
+                    failed.set()
+                    raise
+
+    run_parallel([worker] * min(max_workers, len(tasks)), max_workers)
+    return results
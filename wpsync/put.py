@@ -1,30 +1,49 @@
 import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
 from crayons import blue, cyan, yellow, red, green, ColoredString
 
 
+# when several sites are worked on at the same time, every line
+# is prefixed with the name of the site it belongs to
+_prefix = ContextVar("prefix", default="")
+
+
+@contextmanager
+def prefix(name):
+    token = _prefix.set(f"[{name}] ")
+    try:
+        yield
+    finally:
+        _prefix.reset(token)
+
+
 def normal(string, always=False, bold=False):
     return ColoredString('RESET', string, always_color=always, bold=bold)
 
 
 def title(message):
-    print(f'{blue("➙")} {normal(message, bold=True)}')
+    print(f'{_prefix.get()}{blue("➙")} {normal(message, bold=True)}')
 
 
 def step(message):
-    print(normal(f'• {message}'))
+    print(normal(f'{_prefix.get()}• {message}'))
 
 
 def error(message):
-    print(f'{red("✗")} {red(message, bold=True)}', file=sys.stderr)
+    print(
+        f'{_prefix.get()}{red("✗")} {red(message, bold=True)}',
+        file=sys.stderr,
+    )
 
 
 def warn(message):
-    print(f'{yellow("⚠")} {normal(message)}')
+    print(f'{_prefix.get()}{yellow("⚠")} {normal(message)}')
 
 
 def info(message):
-    print(f'{normal("ℹ")} {normal(message)}')
+    print(f'{_prefix.get()}{normal("ℹ")} {normal(message)}')
 
 
 def success(message):
-    print(f'{green("✔")} {normal(message, bold=True)}')
+    print(f'{_prefix.get()}{green("✔")} {normal(message, bold=True)}')
@@ -1,75 +1,39 @@
 import sys
-from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
+from functools import partial
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from pathlib import Path
 from shlex import quote
 from urllib.parse import urlparse
 import re
+import time
+from threading import Lock
 import sqlparse
 from .host_info import HostInfo
-from . import put
+from . import bulk_load, put
 from .connection import RemoteExecutionError
+from .parallel import run_on_handles
+from .search_replace import SearchReplace
+from .sql_dump import (
+    filter_tables,
+    find_dump,
+    is_compressed,
+    is_create_table,
+    is_insert,
+    iter_statements,
+    load_index,
+    open_dump,
+    read_manifest,
+)
 
 
 this_dir = Path(__file__).resolve().parent
-mysqlsource_php_template = """<?php
-
-ini_set('display_errors', 1);
-ini_set('display_startup_errors', 1);
-error_reporting(E_ALL);
-
-include_once(__DIR__ . '/import-sql-database-mysql.php');
-
-try {{
-
-    IMPORT_TABLES(
-        '{mysql_host}',
-        '{mysql_user}',
-        '{mysql_pass}',
-        '{mysql_name}',
-        {mysql_port},
-        __DIR__ . '/dump.sql'
-    );
-
-}} catch (Exception $e) {{
-
-    http_response_code(500);
-    echo $e->getMessage();
-}}
-"""
-
-
-mysqlreplace_php_template = """<?php
-
-require_once(__DIR__ . '/srdb.class.php');
-
-ob_start();
-$report = new icit_srdb(array(
-    'verbose' => true,
-    'dry_run' => false,
-    'host' => '{mysql_host}',
-    'name' => '{mysql_name}',
-    'user' => '{mysql_user}',
-    'pass' => '{mysql_pass}',
-    'port' => {mysql_port},
-    'search' => '{search}',
-    'replace' => '{replace}',
-));
-$output = ob_get_clean();
-
-if (!$report || !empty($report->errors['results'])) {{
-
-    http_response_code(500);
-    if (!$report) {{
-        echo "The search-replace-database-tool didn't return a report.\n";
-    }}
-
-    if (!empty($report->errors['results'])) {{
-        foreach ($report->errors['results'] as $error) {{
-            echo "$error\n";
-        }}
-    }}
-}}
-"""
+# the import runs in chunks of about this many seconds, each in its
+# own request, to stay clear of max_execution_time and proxy timeouts
+import_chunk_seconds = 20
+# tables are imported in parallel, and each of them may store how far
+# its import got in the host info
+import_progress_lock = Lock()
 
 
 def restore(
@@ -84,6 +48,7 @@ def restore(
     plugins,
     themes,
     full,
+    tables=None,
 ):
     host = HostInfo(wpsyncdir, dest, connection)
     backup_dir = wpsyncdir / "backups" / source["fs_safe_name"] / fs_ts
@@ -95,7 +60,9 @@ def restore(
         put.title(f"Restoring {what}")
 
     if database or full:
-        restore_database(source, dest, connection, backup_dir, host, quiet)
+        restore_database(
+            source, dest, connection, backup_dir, host, quiet, tables
+        )
 
     if uploads:
         restore_a_dir(backup_dir, dest, connection, "uploads", quiet)
@@ -128,14 +95,29 @@ def restore(
             connection.put(local_htaccess_file, remote_htacces_file)
 
 
-def restore_database(source, dest, connection, backup_dir, host, quiet):
-    dump_file = backup_dir / "database" / "dump.sql"
-    if not dump_file.is_file():
+def restore_database(
+    source, dest, connection, backup_dir, host, quiet, tables=None
+):
+    database_dir = backup_dir / "database"
+    manifest = read_manifest(database_dir)
+    dump_file = find_dump(database_dir)
+    if not manifest and not dump_file:
         put.error("Database is not contained in this backup")
         return
+    if tables:
+        if manifest:
+            names = [table["name"] for table in manifest["tables"]]
+        else:
+            names = load_index(dump_file)["tables"].keys()
+        unknown = [table for table in tables if table not in names]
+        if unknown:
+            put.error(f'Not in this backup: {", ".join(unknown)}')
+            return
     if not quiet:
         put.step("Restoring database")
 
+    db_settings = None
+    search_replace = None
     if dest != source:
         if not quiet:
             put.info("Altering database dump to match target settings")
@@ -147,39 +129,7 @@ def restore_database(source, dest, connection, backup_dir, host, quiet):
                 + f'\n  Create a backup for {dest["name"]} first!'
             )
             sys.exit(1)
-        temp_dump_file = Path(NamedTemporaryFile().name)
-        replace_in_database_dump(dump_file, temp_dump_file, db_settings)
-
-        # use modified dump for import
-        dump_file = temp_dump_file
-
-    remote_dump_file = connection.normalise("dump.sql")
-    connection.put(dump_file, remote_dump_file)
-
-    php_code = mysqlsource_php_template.format(**dest)
-    mysqlimport_library_local = this_dir / "import-sql-database-mysql.php"
-    mysqlimport_library_remote = connection.normalise(
-        "import-sql-database-mysql.php"
-    )
-    connection.put(mysqlimport_library_local, mysqlimport_library_remote)
-    try:
-        connection.run_php(php_code)
-    except RemoteExecutionError as error:
-        put.error(f"Error importing the SQL dump: {error}")
-        return
-    finally:
-        connection.rm(mysqlimport_library_remote)
-        connection.rm(remote_dump_file)
 
-    if "temp_dump_file" in locals():
-        temp_dump_file.unlink()
-
-    if dest != source:
-        if not quiet:
-            put.step("Replacing urls in the database")
-        # TODO:
-        # escape quotes in all strings formatted into php
-        # templates!
         # NOTE
         # replacing only the domain instead of the full site_url
         # here, because sometimes urls deep in custom fields didn't
@@ -188,18 +138,411 @@ def restore_database(source, dest, connection, backup_dir, host, quiet):
         # match
         source_domain = urlparse(source["site_url"]).netloc
         dest_domain = urlparse(dest["site_url"]).netloc
-        php_code = mysqlreplace_php_template.format(
-            search=source_domain, replace=dest_domain, **dest
+        # plus the pairs from the config, all of them are replaced
+        # in one pass, the longest search first
+        searches = SearchReplace(
+            [(source_domain, dest_domain), *dest["search_replace_pairs"]]
         )
-        mysqlreplace_library_local = this_dir / "srdb.class.php"
-        mysqlreplace_library_remote = connection.normalise("srdb.class.php")
-        connection.put(mysqlreplace_library_local, mysqlreplace_library_remote)
+        if dest["search_replace"] == "local":
+            if not quiet:
+                put.info("Replacing urls in the database dump")
+            search_replace = searches
+
+    # for the replacement on the server: the tables and columns that
+    # contain the urls, according to the dumps
+    found = {}
+
+    try:
+        with TemporaryDirectory() as temp_dir, bulk_load_tunnel(
+            connection, dest
+        ) as mysql_address:
+            temp_dir = Path(temp_dir)
+
+            # per-table backups: import the selected table files, in
+            # parallel, and then the views, unless only some tables
+            # are restored. with every file goes how to get the rows
+            # of its tables, which bulk loading needs (but only asks
+            # for if it's possible)
+            view_files = []
+            if manifest:
+                table_files = [
+                    (
+                        table["name"],
+                        database_dir / table["file"],
+                        partial(dict, {table["name"]: table["rows"]}),
+                    )
+                    for table in manifest["tables"]
+                    if not tables or table["name"] in tables
+                ]
+                if manifest["views"] and not tables:
+                    view_files.append(
+                        (
+                            "views",
+                            database_dir / manifest["views"]["file"],
+                            dict,
+                        )
+                    )
+
+            # single dump backups: pick the selected tables out of
+            # the dump first
+            elif tables:
+                filtered_dump_file = temp_dir / dump_file.name
+                filter_tables(dump_file, filtered_dump_file, tables)
+                table_files = [
+                    (
+                        "database",
+                        filtered_dump_file,
+                        partial(dump_table_rows, dump_file, tables),
+                    )
+                ]
+            else:
+                table_files = [
+                    (
+                        "database",
+                        dump_file,
+                        partial(dump_table_rows, dump_file),
+                    )
+                ]
+
+            total = len(table_files) + len(view_files)
+            imported = []
+            imported_lock = Lock()
+            started = time.perf_counter()
+
+            def import_task(name, dump_file, table_rows):
+                def task(connection):
+                    start = time.perf_counter()
+                    restore_dump_file(
+                        connection,
+                        dest,
+                        host,
+                        backup_dir,
+                        dump_file,
+                        mysql_address,
+                        table_rows,
+                        db_settings,
+                        search_replace,
+                        temp_dir,
+                        quiet,
+                    )
+                    with imported_lock:
+                        imported.append(name)
+                        done = len(imported)
+                    if total > 1 and not quiet:
+                        put.info(
+                            f"Imported {name} in"
+                            f" {time.perf_counter() - start:.1f} s"
+                            f" ({done}/{total})"
+                        )
+                    if dest != source and dest["search_replace"] == "remote":
+                        return searches.find_in_dump(dump_file)
+                    return {}
+
+                return task
+
+            # every import sets foreign_key_checks = 0 for its own
+            # session, so the tables can go in in any order
+            results = run_on_handles(
+                connection,
+                [import_task(*table_file) for table_file in table_files],
+                dest["concurrency"],
+            )
+            for view_file in view_files:
+                results.append(import_task(*view_file)(connection))
+            for result in results:
+                for table, columns in result.items():
+                    found.setdefault(table, set()).update(columns)
+            if total > 1 and not quiet:
+                put.info(
+                    f"Imported {total} dump files in"
+                    f" {time.perf_counter() - started:.1f} s"
+                )
+    except RemoteExecutionError as error:
+        put.error(f"Error importing the SQL dump: {error}")
+        return
+
+    if dest != source and dest["search_replace"] == "remote":
+        if not quiet:
+            put.step("Replacing urls in the database")
+        if not found:
+            if not quiet:
+                put.info("The urls don't occur in the database")
+            return
+        # srdb looks at all columns if it gets none
+        include_cols = set()
+        if not any(None in columns for columns in found.values()):
+            include_cols = set.union(*found.values())
         try:
-            connection.run_php(php_code)
+            connection.agent(
+                [
+                    {
+                        "op": "replace",
+                        "search": [s.decode("utf-8") for s in searches.pairs],
+                        "replace": [
+                            r.decode("utf-8") for r in searches.pairs.values()
+                        ],
+                        "tables": sorted(found),
+                        "include_cols": sorted(include_cols),
+                    }
+                ]
+            )
         except RemoteExecutionError as error:
             put.error(error)
+
+
+# the address of the site's mysql server for bulk loading while the
+# context lasts, or None if the big tables can't be bulk loaded
+@contextmanager
+def bulk_load_tunnel(connection, dest):
+    if not dest["bulk_load"]:
+        yield None
+    elif bulk_load.pymysql is None:
+        put.warn("bulk_load needs pymysql, which isn't installed")
+        yield None
+    else:
+        with connection.mysql_tunnel() as mysql_address:
+            yield mysql_address
+
+
+# the rows per table of a single dump (or of the given tables in it),
+# from the index the backup has for it
+def dump_table_rows(dump_file, tables=None):
+    return {
+        table: entry["rows"]
+        for table, entry in load_index(dump_file)["tables"].items()
+        if not tables or table in tables
+    }
+
+
+def restore_dump_file(
+    connection,
+    dest,
+    host,
+    backup_dir,
+    dump_file,
+    mysql_address,
+    table_rows,
+    db_settings,
+    search_replace,
+    temp_dir,
+    quiet,
+):
+    dump_file_name = dump_file.name
+    is_modified = db_settings is not None or search_replace is not None
+    if is_modified:
+        # use modified dump for import
+        modified_dump_file = temp_dir / f"modified-{dump_file_name}"
+        replace_in_database_dump(
+            dump_file, modified_dump_file, db_settings, search_replace
+        )
+        dump_file = modified_dump_file
+
+    try:
+        # the big tables are bulk loaded if we can reach the server
+        bulk_tables = []
+        if mysql_address is not None:
+            bulk_tables = bulk_load.large_tables(table_rows())
+        if bulk_tables:
+            import_with_bulk_load(
+                connection,
+                dest,
+                host,
+                backup_dir,
+                dump_file,
+                dump_file_name,
+                bulk_tables,
+                mysql_address,
+                temp_dir,
+                quiet,
+            )
+        else:
+            import_file(
+                connection, host, backup_dir, dump_file, dump_file_name
+            )
+    finally:
+        if is_modified:
+            dump_file.unlink()
+
+
+def import_file(connection, host, backup_dir, dump_file, dump_file_name):
+    # mysql on the server imports the dump as it arrives. without it,
+    # the dump is uploaded and imported in chunks by the agent
+    if connection.has_native_mysql():
+        connection.native_import(dump_file)
+    else:
+        remote_dump_file = connection.normalise(dump_file_name)
+        connection.put(dump_file, remote_dump_file)
+        remote_files = [remote_dump_file]
+        import_file_name = dump_file_name
+        try:
+            # finding the offset of a chunk in a compressed dump would
+            # mean inflating all of it up to there, for every chunk.
+            # so the dump is inflated once, and the copy is imported
+            if is_compressed(dump_file_name):
+                import_file_name = dump_file_name[: -len(".gz")]
+                remote_files.append(connection.normalise(import_file_name))
+                inflate_dump(connection, dump_file_name, import_file_name)
+            import_dump(
+                connection,
+                host,
+                backup_dir,
+                dump_file,
+                dump_file_name,
+                import_file_name,
+            )
         finally:
-            connection.rm(mysqlreplace_library_remote)
+            for remote_file in remote_files:
+                if connection.file_exists(remote_file):
+                    connection.rm(remote_file)
+
+
+def inflate_dump(connection, dump_file_name, plain_file_name):
+    while True:
+        [result] = connection.agent(
+            [
+                {
+                    "op": "inflate",
+                    "file": dump_file_name,
+                    "target": plain_file_name,
+                    "max_seconds": import_chunk_seconds,
+                }
+            ]
+        )
+        if result["done"]:
+            break
+
+
+# everything but the rows of the big tables is imported as usual, so
+# the tables exist. then their rows are loaded with LOAD DATA, and
+# the tables for which that fails are imported as usual after all
+def import_with_bulk_load(
+    connection,
+    dest,
+    host,
+    backup_dir,
+    dump_file,
+    dump_file_name,
+    bulk_tables,
+    mysql_address,
+    temp_dir,
+    quiet,
+):
+    rest_file = temp_dir / f"rest-{dump_file_name}"
+    table_files = {
+        table: temp_dir / f"bulk-{i}-{dump_file_name}"
+        for i, table in enumerate(bulk_tables)
+    }
+    try:
+        bulk_load.split_inserts(dump_file, rest_file, table_files)
+        import_file(
+            connection, host, backup_dir, rest_file, f"rest-{dump_file_name}"
+        )
+        # tables without any INSERTs in the dump get no file
+        loaded_files = {
+            table: file for table, file in table_files.items() if file.exists()
+        }
+        if not loaded_files:
+            return
+        if not quiet:
+            put.info(f'Bulk loading {", ".join(loaded_files)}')
+        failed = bulk_load.load_tables(
+            mysql_address, dest, loaded_files, temp_dir
+        )
+        for table, error in failed.items():
+            if not quiet:
+                put.info(f"Bulk loading {table} failed ({error})")
+            import_file(
+                connection,
+                host,
+                backup_dir,
+                table_files[table],
+                table_files[table].name,
+            )
+    finally:
+        for file in [rest_file, *table_files.values()]:
+            if file.exists():
+                file.unlink()
+
+
+# imports the dump in chunks from the (plain) copy of it on the
+# server, remembering in the host info how far it got, so that a
+# failed import can be resumed by running the restore again instead
+# of starting over
+def import_dump(
+    connection, host, backup_dir, dump_file, dump_file_name, import_file_name
+):
+    progress_key = {
+        "backup": str(backup_dir),
+        "name": dump_file_name,
+        "compressed": is_compressed(dump_file_name),
+        "size": dump_file.stat().st_size,
+    }
+    progress = get_import_progress(host, dump_file_name)
+    offset = 0
+    if progress and progress["dump"] == progress_key:
+        offset = progress["offset"]
+        put.info(f"Resuming the import of {dump_file_name} at byte {offset}")
+
+    errors = []
+    while True:
+        try:
+            [result] = connection.agent(
+                [
+                    {
+                        "op": "import",
+                        "file": import_file_name,
+                        "compressed": is_compressed(import_file_name),
+                        "offset": offset,
+                        "max_seconds": import_chunk_seconds,
+                    }
+                ]
+            )
+        except RemoteExecutionError:
+            if get_import_progress(host, dump_file_name):
+                put.info("Run the restore again to resume the import")
+            raise
+        # statements that failed are reported, but the chunk is
+        # committed anyway and the import goes on, so that as much
+        # as possible is restored. resuming after that would skip
+        # the failed statements, so from then on no progress is kept
+        if result["output"]:
+            errors.append(result["output"])
+        if result["offset"] is not None and not errors:
+            set_import_progress(
+                host,
+                dump_file_name,
+                {"dump": progress_key, "offset": result["offset"]},
+            )
+        else:
+            set_import_progress(host, dump_file_name, None)
+        if result["offset"] is None:
+            break
+        offset = result["offset"]
+    if errors:
+        raise RemoteExecutionError("\n".join(errors))
+
+
+# the progress of imports is stored per dump file name
+def get_import_progress(host, dump_file_name):
+    with import_progress_lock:
+        return host.get("import_progress", {}).get(dump_file_name)
+
+
+def set_import_progress(host, dump_file_name, progress):
+    with import_progress_lock:
+        all_progress = host.get("import_progress", {})
+        # older versions stored the progress of a single dump
+        if "offset" in all_progress:
+            all_progress = {}
+        all_progress = dict(all_progress)
+        if progress is None:
+            all_progress.pop(dump_file_name, None)
+        else:
+            all_progress[dump_file_name] = progress
+        if all_progress:
+            host["import_progress"] = all_progress
+        elif "import_progress" in host:
+            del host["import_progress"]
 
 
 def restore_a_dir(backup_dir, dest, connection, name, quiet):
@@ -217,52 +560,55 @@ def restore_a_dir(backup_dir, dest, connection, name, quiet):
     connection.mirror_r(local_dir, remote_dir)
 
 
-def replace_in_database_dump(in_file, out_file, to_set):
-    db_dump = in_file.read_text(encoding="utf-8")
-    statements = sqlparse.parse(db_dump)
+def replace_in_database_dump(
+    in_file, out_file, to_set=None, search_replace=None
+):
+    # stream the dump statement by statement and only hand CREATE
+    # TABLE statements to sqlparse and INSERTs to search_replace;
+    # everything else (DROPs, comments) is copied through as it is
+    with open_dump(in_file) as source, open_dump(out_file, "wb") as target:
+        for statement in iter_statements(source):
+            if to_set is not None and is_create_table(statement):
+                statement = replace_in_create_statement(
+                    statement.decode("utf-8"), to_set
+                ).encode("utf-8")
+            elif search_replace is not None and is_insert(statement):
+                statement = search_replace.replace_in_insert(statement)
+            target.write(statement)
+
+
+def replace_in_create_statement(create_statement, to_set):
+    # sqlparse drops trailing whitespace, keep it to put it back
+    body = create_statement.rstrip()
+    trailing_whitespace = create_statement[len(body) :]
+    statements = sqlparse.parse(body)
     detected_keyword = None
-    serialised = []
     detected_collate = False
-    for statement in statements:
-
-        # only look at CREATE statements to replace values in
-        if statement.token_first().value == "CREATE":
-            for token in statement.flatten():
-                if token.value in to_set:
-                    detected_keyword = token.value
-                elif (
-                    detected_keyword
-                    and token.ttype == sqlparse.tokens.Token.Name
-                ):
-                    token.value = to_set[detected_keyword]
-                    detected_keyword = None
-
-                # if COLLATE is not in to_set, we want to remove
-                # COLLATE definitions from the dump
-                # so we delete all token values from here up to
-                # and including the next sqlparse.tokens.Token.Name
-                # TODO this leaves trailing whitespace in some places
-                # in the modified dump file which works but doesn't
-                # seem like a clean solution
-                elif token.value == "COLLATE":
-                    detected_collate = True
-                    token.value = ""
-                elif (
-                    detected_collate
-                    and token.ttype != sqlparse.tokens.Token.Name
-                ):
-                    token.value = ""
-                elif (
-                    detected_collate
-                    and token.ttype == sqlparse.tokens.Token.Name
-                ):
-                    token.value = ""
-                    detected_collate = False
-
-        serialised.append(str(statement))
-
-    modified_db_dump = "".join(serialised)
-    out_file.write_text(modified_db_dump, encoding="utf-8")
+    tokens = [token for s in statements for token in s.flatten()]
+    for token in tokens:
+        if token.value in to_set:
+            detected_keyword = token.value
+        elif detected_keyword and token.ttype == sqlparse.tokens.Token.Name:
+            token.value = to_set[detected_keyword]
+            detected_keyword = None
+
+        # if COLLATE is not in to_set, we want to remove
+        # COLLATE definitions from the dump
+        # so we delete all token values from here up to
+        # and including the next sqlparse.tokens.Token.Name
+        # TODO this leaves trailing whitespace in some places
+        # in the modified dump file which works but doesn't
+        # seem like a clean solution
+        elif token.value == "COLLATE":
+            detected_collate = True
+            token.value = ""
+        elif detected_collate and token.ttype != sqlparse.tokens.Token.Name:
+            token.value = ""
+        elif detected_collate and token.ttype == sqlparse.tokens.Token.Name:
+            token.value = ""
+            detected_collate = False
+    serialised = [str(statement) for statement in statements]
+    return "".join(serialised) + trailing_whitespace
 
 
 def adapt_wp_config_php(in_file, out_file, site):
@@ -0,0 +1,183 @@
+import re
+from .sql_dump import (
+    is_create_table,
+    is_insert,
+    iter_rows,
+    iter_statements,
+    open_dump,
+    table_of,
+)
+
+
+# string literals in a dump are quoted and escaped like PDO::quote
+# (and mysqldump) do it
+_LITERAL = re.compile(rb"'[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL)
+_ESCAPE_SEQUENCE = re.compile(rb"\\(.)", re.DOTALL)
+_UNESCAPED = {
+    b"0": b"\0",
+    b"b": b"\b",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"Z": b"\x1a",
+}
+_TO_ESCAPE = re.compile(rb"[\\'\"\0\n\r\x1a]")
+_ESCAPED = {
+    b"\\": b"\\\\",
+    b"'": b"\\'",
+    b'"': b'\\"',
+    b"\0": b"\\0",
+    b"\n": b"\\n",
+    b"\r": b"\\r",
+    b"\x1a": b"\\Z",
+}
+
+# the parts of PHP's serialize() format we have to understand
+_SERIALIZED_START = re.compile(rb"[asOCidbN][:;]")
+_SERIALIZED_STRING = re.compile(rb's:(\d+):"')
+_SERIALIZED_CONTAINER = re.compile(rb'(?:a|O:\d+:"[^"]*"):(\d+):\{')
+_SERIALIZED_CUSTOM = re.compile(rb'C:\d+:"[^"]*":(\d+):\{')
+_SERIALIZED_SCALAR = re.compile(rb"(?:[idbrR]:[^;]*|N);")
+
+# column definitions in a CREATE TABLE statement
+_COLUMN_DEFINITION = re.compile(rb"^\s*`((?:[^`]|``)+)`", re.MULTILINE)
+
+
+def unescape(literal):
+    return _ESCAPE_SEQUENCE.sub(lambda m: _UNESCAPED.get(m[1], m[1]), literal)
+
+
+def escape(value):
+    return _TO_ESCAPE.sub(lambda m: _ESCAPED[m[0]], value)
+
+
+class SearchReplace:
+    """
+    Replaces strings in the values of INSERT statements the way
+    the search-replace-database tool does it on the server: inside
+    PHP-serialized values the string lengths are fixed, and URLs
+    are also found with their slashes escaped for JSON.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = {}
+        for search, replace in pairs:
+            search = search.encode("utf-8")
+            replace = replace.encode("utf-8")
+            self.pairs[search] = replace
+            self.pairs.setdefault(
+                search.replace(b"/", b"\\/"), replace.replace(b"/", b"\\/")
+            )
+        # the longest search wins where several of them match
+        searches = sorted(self.pairs, key=len, reverse=True)
+        self.pattern = re.compile(b"|".join(re.escape(s) for s in searches))
+        # how the searches look in a dump, to skip what doesn't
+        # contain any of them without unescaping it
+        self.escaped_searches = [escape(s) for s in searches]
+
+    def _contains_search(self, data):
+        return any(s in data for s in self.escaped_searches)
+
+    def replace_in_insert(self, statement):
+        if not self._contains_search(statement):
+            return statement
+        return _LITERAL.sub(self._replace_in_literal, statement)
+
+    def _replace_in_literal(self, match):
+        literal = match[0]
+        if not self._contains_search(literal):
+            return literal
+        value = self.replace_in_value(unescape(literal[1:-1]))
+        return b"'" + escape(value) + b"'"
+
+    def replace_in_value(self, value):
+        if not self.pattern.search(value):
+            return value
+        if _SERIALIZED_START.match(value):
+            try:
+                replaced, end = self._replace_in_serialized(value, 0)
+                if end == len(value):
+                    return replaced
+            except (ValueError, RecursionError):
+                pass
+        # not serialized (or broken anyway)
+        return self.pattern.sub(lambda m: self.pairs[m[0]], value)
+
+    # returns the serialized value at pos with the searches replaced
+    # in all of its strings (but not in array keys and property
+    # names), and the position after it
+    def _replace_in_serialized(self, data, pos, replace=True):
+        match = _SERIALIZED_STRING.match(data, pos)
+        if match:
+            start = match.end()
+            end = start + int(match[1])
+            if data[end : end + 2] != b'";':
+                raise ValueError("Broken serialized string")
+            if not replace:
+                return data[pos : end + 2], end + 2
+            # strings may contain serialized values themselves
+            string = self.replace_in_value(data[start:end])
+            return b's:%d:"%s";' % (len(string), string), end + 2
+
+        match = _SERIALIZED_CONTAINER.match(data, pos)
+        if match:
+            parts = [match[0]]
+            pos = match.end()
+            for i in range(2 * int(match[1])):
+                part, pos = self._replace_in_serialized(
+                    data, pos, replace and i % 2 == 1
+                )
+                parts.append(part)
+            if data[pos : pos + 1] != b"}":
+                raise ValueError("Broken serialized array or object")
+            parts.append(b"}")
+            return b"".join(parts), pos + 1
+
+        # objects that serialize themselves are left alone, we can't
+        # know what their data looks like
+        match = _SERIALIZED_CUSTOM.match(data, pos)
+        if match:
+            end = match.end() + int(match[1])
+            if data[end : end + 1] != b"}":
+                raise ValueError("Broken serialized object")
+            return data[pos : end + 1], end + 1
+
+        match = _SERIALIZED_SCALAR.match(data, pos)
+        if match:
+            return match[0], match.end()
+        raise ValueError("Not a serialized value")
+
+    def find_in_dump(self, dump_file):
+        """
+        Return the tables of a dump that contain any of the searches,
+        mapped to the names of the columns they were found in.
+        """
+        columns = {}
+        found = {}
+        with open_dump(dump_file) as dump:
+            for statement in iter_statements(dump):
+                if is_create_table(statement):
+                    columns[table_of(statement)] = [
+                        c.replace(b"``", b"`").decode("utf-8")
+                        for c in _COLUMN_DEFINITION.findall(statement)
+                    ]
+                elif is_insert(statement) and self._contains_search(
+                    statement
+                ):
+                    table = table_of(statement)
+                    found.setdefault(table, set()).update(
+                        self._find_in_insert(statement, columns.get(table))
+                    )
+        return found
+
+    def _find_in_insert(self, statement, columns):
+        found = set()
+        for row in iter_rows(statement):
+            for column, value in enumerate(row):
+                if value[:1] == b"'" and self._contains_search(value):
+                    if columns is None or column >= len(columns):
+                        # we don't know the column's name
+                        found.add(None)
+                    else:
+                        found.add(columns[column])
+        return found
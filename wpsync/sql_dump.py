@@ -0,0 +1,373 @@
+import gzip
+import json
+import re
+
+
+# a dump is read line by line as bytes. statements are only joined
+# when they span several lines (CREATE TABLE does, INSERTs don't),
+# so memory use is bounded by the longest statement, not by the
+# size of the dump.
+#
+# to know whether a line ending in ; really ends a statement, we
+# have to know if we're inside a quoted string. the regexes below
+# find that out without looping over every byte in python: they
+# are "unrolled" so they never backtrack catastrophically, even on
+# megabyte-long INSERT lines.
+_UNQUOTED = re.compile(
+    rb"[^'\"`\\]*"
+    rb"(?:"
+    rb"(?:\\.|'[^'\\]*(?:\\.[^'\\]*)*'"
+    rb'|"[^"\\]*(?:\\.[^"\\]*)*"'
+    rb"|`[^`]*`)"
+    rb"[^'\"`\\]*"
+    rb")*",
+    re.DOTALL,
+)
+_CLOSING_QUOTE = {
+    b"'": re.compile(rb"[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL),
+    b'"': re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+    b"`": re.compile(rb"[^`]*`"),
+}
+
+
+def _scan_quotes(line, quote):
+    # returns the quote character that is still open at the end of
+    # the line, or None
+    pos = 0
+    end = len(line)
+    while True:
+        if quote is not None:
+            match = _CLOSING_QUOTE[quote].match(line, pos)
+            if not match:
+                return quote
+            pos = match.end()
+            quote = None
+        pos = _UNQUOTED.match(line, pos).end()
+        if pos >= end:
+            return None
+        quote = line[pos : pos + 1]
+        pos += 1
+
+
+def iter_statements(dump):
+    """
+    Yield the statements of an SQL dump (an open binary file) as
+    bytes, exactly as they appear in the dump. Comment lines and
+    empty lines between statements are yielded on their own, so
+    joining everything that is yielded gives back the dump.
+    """
+    lines = []
+    quote = None
+    for line in dump:
+        if not lines and (line.startswith(b"--") or not line.strip()):
+            yield line
+            continue
+        lines.append(line)
+        quote = _scan_quotes(line, quote)
+        if quote is None and line.rstrip().endswith(b";"):
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+
+
+def is_create_table(statement):
+    return statement.lstrip()[:12].upper() == b"CREATE TABLE"
+
+
+def is_insert(statement):
+    return statement.lstrip()[:11].upper() == b"INSERT INTO"
+
+
+_TABLE_STATEMENT = re.compile(
+    rb"\s*(?:/\*!\d+\s*)?"
+    rb"(?:DROP TABLE IF EXISTS|DROP VIEW IF EXISTS|CREATE TABLE"
+    rb"(?: IF NOT EXISTS)?|INSERT INTO|LOCK TABLES|ALTER TABLE)"
+    rb"\s+`((?:[^`]|``)+)`",
+    re.IGNORECASE,
+)
+# views and triggers are created with clauses (algorithm, definer ...)
+# between CREATE and the name, each in a comment of its own. triggers
+# belong to the table they're on
+_CLAUSES = rb"(?:[^;`]|`(?:[^`]|``)*`)*?"
+_CREATE_VIEW_OR_TRIGGER = re.compile(
+    rb"\s*(?:/\*!\d+\s*)?CREATE\b" + _CLAUSES + rb"\b(?:"
+    rb"VIEW\s+`((?:[^`]|``)+)`"
+    rb"|TRIGGER\s+`(?:[^`]|``)+`[^;`]*?\bON\s+`((?:[^`]|``)+)`"
+    rb")",
+    re.IGNORECASE,
+)
+_DROP_TRIGGER = re.compile(rb"\s*(?:/\*!\d+\s*)?DROP TRIGGER\b", re.IGNORECASE)
+
+
+# the table a statement is about, or None for statements that don't
+# belong to a particular table (SET, comments, ...)
+def table_of(statement):
+    match = _TABLE_STATEMENT.match(statement)
+    if not match:
+        match = _CREATE_VIEW_OR_TRIGGER.match(statement)
+        if not match:
+            return None
+    name = match[1] if match[1] is not None else match[2]
+    return name.replace(b"``", b"`").decode("utf-8")
+
+
+# the values of an INSERT statement taken apart into literals, other
+# values and the parentheses and commas around them
+_VALUES_TOKEN = re.compile(
+    rb"'[^'\\]*(?:\\.[^'\\]*)*'|[^'(),]+|[(),]", re.DOTALL
+)
+
+
+# yield the rows of an INSERT statement, each as a list of its values
+# as they are written in the statement (literals are still quoted and
+# escaped). parentheses inside a value, as in a function call, are
+# part of the value
+def iter_rows(statement):
+    values = statement.find(b" VALUES ")
+    if values == -1:
+        return
+    row = []
+    value = b""
+    depth = 0
+    for token in _VALUES_TOKEN.findall(statement, values + 8):
+        if token == b"(":
+            depth += 1
+            if depth == 1:
+                row = []
+                continue
+        elif token == b")":
+            depth -= 1
+            if depth == 0:
+                row.append(value.strip())
+                value = b""
+                yield row
+                continue
+        elif token == b"," and depth == 1:
+            row.append(value.strip())
+            value = b""
+            continue
+        if depth > 0:
+            value += token
+
+
+# copy a dump, leaving out everything that belongs to tables other
+# than the given ones. the index tells us where those are, so we
+# only read what we keep
+def filter_tables(in_file, out_file, tables):
+    index = load_index(in_file)
+    ranges = list(index["shared"])
+    for table in tables:
+        if table in index["tables"]:
+            ranges.extend(index["tables"][table]["ranges"])
+    with open_dump(out_file, "wb") as target:
+        for chunk in read_ranges(in_file, sorted(ranges)):
+            target.write(chunk)
+
+
+# database backups contain either a plain or a gzip-compressed dump,
+# or a dump file per table (see read_manifest)
+DUMP_FILE_NAMES = ["dump.sql", "dump.sql.gz"]
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def find_dump(database_dir):
+    for name in DUMP_FILE_NAMES:
+        if (database_dir / name).is_file():
+            return database_dir / name
+    return None
+
+
+def is_compressed(path):
+    return str(path).endswith(".gz")
+
+
+# open a dump for reading or writing as a binary file,
+# (de)compressing on the fly if its name says it's compressed. the
+# dumps we write are temporary copies that are read once, so they
+# are compressed as fast as possible instead of as small
+def open_dump(path, mode="rb"):
+    if is_compressed(path):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+
+_TAIL_SIZE = 4096
+
+
+# dumps (from Mysqldump.php or mysqldump) end with a "-- Dump
+# completed" comment. returns what's wrong with a dump that doesn't,
+# given its last few kilobytes, or None
+def _tail_error(tail):
+    if b"-- Dump completed" in tail:
+        return None
+    error = tail.rpartition(b"-- WPSYNC_ERROR ")[2]
+    if error != tail:
+        return error.decode("utf-8", errors="replace").strip()
+    return "The dump is incomplete"
+
+
+# index a dump that has just been written, and check it in the same
+# pass. returns what's wrong with the dump, or None
+def index_new_dump(path):
+    try:
+        index = index_dump(path)
+    except (OSError, EOFError) as error:
+        return f"The dump is broken: {error}"
+    return index["error"]
+
+
+# per-table database backups come with a manifest that looks like
+# {
+#   "tables": [
+#     {"name": ..., "file": ..., "rows": ..., "bytes": ..., "create": ...},
+#     ...
+#   ],
+#   "views": {"names": [...], "file": ..., "bytes": ...} or null
+# }
+def read_manifest(database_dir):
+    try:
+        with open(database_dir / MANIFEST_FILE_NAME, encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# single dumps get an index next to them (dump.sql.index.json) that
+# maps every table to the byte ranges of its statements in the
+# (uncompressed) dump, so we can seek to a table instead of parsing
+# all of the dump. seeking in a gzipped dump still decompresses
+# everything before the position, so read ranges in one pass, in the
+# order they're in the dump:
+# {
+#   "version": <INDEX_VERSION, to tell if the index is stale>,
+#   "size": <size of the dump file, to tell that as well>,
+#   "tables": {
+#     <name>: {
+#       "rows": ...,
+#       "drop": [start, end] or null,
+#       "create": [start, end] or null,
+#       "ranges": [[start, end], ...]  (all of the table's statements)
+#     },
+#     ...
+#   },
+#   "shared": [[start, end], ...]  (statements that belong to no table),
+#   "error": <what's wrong with the dump, see _tail_error> or null
+# }
+INDEX_FILE_SUFFIX = ".index.json"
+INDEX_VERSION = 3
+_QUOTED = re.compile(
+    rb"'[^'\\]*(?:\\.[^'\\]*)*'|\"[^\"\\]*(?:\\.[^\"\\]*)*\"",
+    re.DOTALL,
+)
+_ROW_SEPARATOR = re.compile(rb"\)\s*,\s*\(")
+
+
+def index_path(dump_path):
+    return dump_path.with_name(dump_path.name + INDEX_FILE_SUFFIX)
+
+
+def count_rows(insert_statement):
+    values = _QUOTED.sub(b"''", insert_statement)
+    return len(_ROW_SEPARATOR.findall(values)) + 1
+
+
+def _add_range(ranges, start, end):
+    # statements that follow each other are merged into one range
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+
+def index_dump(dump_path):
+    tables = {}
+    shared = []
+    # a DROP TRIGGER only names the trigger, it goes with the table
+    # of the CREATE TRIGGER that follows it
+    drop_triggers = []
+    offset = 0
+    tail = b""
+    with open_dump(dump_path) as dump:
+        for statement in iter_statements(dump):
+            start = offset
+            offset += len(statement)
+            if len(statement) >= _TAIL_SIZE:
+                tail = statement[-_TAIL_SIZE:]
+            else:
+                tail = (tail + statement)[-_TAIL_SIZE:]
+            table = table_of(statement)
+            if table is None:
+                if _DROP_TRIGGER.match(statement):
+                    drop_triggers.append([start, offset])
+                else:
+                    _add_range(shared, start, offset)
+                continue
+            if table not in tables:
+                tables[table] = {
+                    "rows": 0,
+                    "drop": None,
+                    "create": None,
+                    "ranges": [],
+                }
+            entry = tables[table]
+            for drop_trigger in drop_triggers:
+                _add_range(entry["ranges"], *drop_trigger)
+            drop_triggers = []
+            _add_range(entry["ranges"], start, offset)
+            if is_insert(statement):
+                entry["rows"] += count_rows(statement)
+            elif statement.lstrip()[:10].upper() == b"DROP TABLE":
+                entry["drop"] = [start, offset]
+            elif is_create_table(statement):
+                entry["create"] = [start, offset]
+    for drop_trigger in drop_triggers:
+        _add_range(shared, *drop_trigger)
+    index = {
+        "version": INDEX_VERSION,
+        "size": dump_path.stat().st_size,
+        "tables": tables,
+        "shared": shared,
+        "error": _tail_error(tail),
+    }
+    with open(index_path(dump_path), "w", encoding="utf8") as f:
+        json.dump(index, f)
+    return index
+
+
+# the index of a dump, which is built first if there is none yet (or
+# it doesn't belong to the dump as it is now)
+def load_index(dump_path):
+    try:
+        with open(index_path(dump_path), encoding="utf8") as f:
+            index = json.load(f)
+        if (
+            index["version"] == INDEX_VERSION
+            and index["size"] == dump_path.stat().st_size
+        ):
+            return index
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    return index_dump(dump_path)
+
+
+# yield the contents of the given byte ranges of a dump, in chunks
+def read_ranges(dump_path, ranges, chunk_size=1024 * 1024):
+    with open_dump(dump_path) as dump:
+        for start, end in ranges:
+            dump.seek(start)
+            while start < end:
+                chunk = dump.read(min(chunk_size, end - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+
+
+# yield each of the given byte ranges of a dump whole, in the order
+# they're in the dump, so a gzipped dump is decompressed only once
+def read_each_range(dump_path, ranges):
+    with open_dump(dump_path) as dump:
+        for start, end in sorted(ranges):
+            dump.seek(start)
+            yield dump.read(end - start)
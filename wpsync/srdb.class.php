@@ -127,6 +127,11 @@ class icit_srdb {
 	 */
 	public $regex = false;
 
+	/**
+	 * @var bool Let MySQL replace in values that aren't serialised
+	 */
+	public $hybrid = false;
+
 	/**
 	 * @var bool Leave guid column alone
 	 */
@@ -259,6 +264,7 @@ class icit_srdb {
 			'include_cols' 		=> array(),
 			'dry_run' 			=> true,
 			'regex' 			=> false,
+			'hybrid' 			=> false,
 			'pagesize' 			=> 50000,
 			'alter_engine' 		=> false,
 			'alter_collation' 	=> false,
@@ -808,9 +814,11 @@ class icit_srdb {
 	 * @return array    Collection of information gathered during the run.
 	 */
 	public function replacer( $search = '', $replace = '', $tables = array( ) ) {
-		$search = (string)$search;
+		// several search/replace pairs may be given as two arrays
+		if ( ! is_array( $search ) )
+			$search = (string)$search;
 		// check we have a search string, bail if not
-		if ( '' === $search ) {
+		if ( '' === $search || array( ) === $search ) {
 			$this->add_error( 'Search string is empty', 'search' );
 			return false;
 		}
@@ -883,8 +891,24 @@ class icit_srdb {
 
 				$this->log( 'search_replace_table_start', $table, $search, $replace );
 
+				// In hybrid mode, values that don't look serialised are replaced by
+				// MySQL, with one UPDATE per column. Only rows with serialised values
+				// that contain the search string are fetched and handled in PHP,
+				// page by page in the order of their primary key
+				$hybrid = $this->get( 'hybrid' ) && ! $this->get( 'regex' ) && ! $dry_run;
+				$where = '';
+				if ( $hybrid ) {
+					list( $select, $where, $changes ) = $this->hybrid_replace( $table, $primary_key, $columns, $search, $replace );
+					$report[ 'change' ] += $changes;
+					$new_table_report[ 'change' ] += $changes;
+					$report[ 'updates' ] += $changes;
+					$new_table_report[ 'updates' ] += $changes;
+					$order = '`' . implode( '`, `', $primary_key ) . '`';
+					$after = '';
+				}
+
 				// Count the number of rows we have in the table if large we'll split into blocks, This is a mod from Simon Wheatley
-				$row_count = $this->db_query( "SELECT COUNT(*) FROM `{$table}`" );
+				$row_count = $this->db_query( "SELECT COUNT(*) FROM `{$table}`" . ( $where ? " WHERE {$where}" : '' ) );
 				$rows_result = $this->db_fetch( $row_count );
 				$row_count = $rows_result[ 0 ];
 
@@ -896,7 +920,10 @@ class icit_srdb {
 					$start = $page * $page_size;
 
 					// Grab the content of the table
-					$data = $this->db_query( sprintf( 'SELECT * FROM `%s` LIMIT %d, %d', $table, $start, $page_size ) );
+					if ( $hybrid )
+						$data = $this->db_query( sprintf( 'SELECT %s FROM `%s` WHERE (%s)%s ORDER BY %s LIMIT %d', $select, $table, $where, $after, $order, $page_size ) );
+					else
+						$data = $this->db_query( sprintf( 'SELECT * FROM `%s` LIMIT %d, %d', $table, $start, $page_size ) );
 
 					if ( ! $data )
 						$this->add_error( $this->db_error( ), 'results' );
@@ -910,6 +937,13 @@ class icit_srdb {
 						$where_sql = array( );
 						$update = false;
 
+						if ( $hybrid ) {
+							$last_key = array( );
+							foreach( $primary_key as $key_column )
+								$last_key[] = $this->db_escape( $row[ $key_column ] );
+							$after = " AND ({$order}) > (" . implode( ', ', $last_key ) . ')';
+						}
+
 						foreach( $columns as $column ) {
 
 							$edited_data = $data_to_fix = $row[ $column ];
@@ -926,6 +960,10 @@ class icit_srdb {
 							// include cols
 							if ( ! empty( $this->include_cols ) && ! in_array( $column, $this->include_cols ) )
 								continue;
+
+							// MySQL has taken care of values that aren't serialised
+							if ( $hybrid && empty( $row[ 'srdb_serialised_' . array_search( $column, $columns ) ] ) )
+								continue;
 							
 							// Run a search replace on the data that'll respect the serialisation.
 							$edited_data = $this->recursive_unserialize_replace( $search, $replace, $data_to_fix );
@@ -1018,6 +1056,105 @@ class icit_srdb {
 	}
 
 
+	/**
+	 * Replace in all values of a table that don't look serialised with
+	 * set-based UPDATEs, and build the query parts to fetch the rows that have
+	 * serialised values containing a search string
+	 *
+	 * @param string $table
+	 * @param array $primary_key
+	 * @param array $columns
+	 * @param string|array $search
+	 * @param string|array $replace
+	 *
+	 * @return array    The select list, the where condition and the number of
+	 * values changed
+	 */
+	public function hybrid_replace( $table, $primary_key, $columns, $search, $replace ) {
+		$pairs = array_combine( (array) $search, (array) $replace );
+		uksort( $pairs, function( $a, $b ) { return strlen( $b ) - strlen( $a ); } );
+
+		// nested REPLACE()s, longest search first, give the same as strtr as
+		// long as no replacement contains a search that comes after it and no
+		// two searches can match overlapping text. otherwise all values are
+		// left to PHP
+		$sql_replace = true;
+		$searches = array_map( 'strval', array_keys( $pairs ) );
+		foreach( $searches as $i => $pair_search ) {
+			foreach( array_slice( $searches, $i + 1 ) as $later_search ) {
+				if ( strpos( $pairs[ $pair_search ], $later_search ) !== false )
+					$sql_replace = false;
+				if ( $this->searches_overlap( $pair_search, $later_search ) )
+					$sql_replace = false;
+			}
+		}
+
+		$serialised = $this->db_escape( '^([aOC]:[0-9]+:|s:[0-9]+:"|[idb]:|N;)' );
+		$select = array( '*' );
+		$where = array( );
+		$changes = 0;
+
+		foreach( $columns as $i => $column ) {
+			if ( in_array( $column, $primary_key ) || in_array( $column, $this->exclude_cols ) )
+				continue;
+			if ( ! empty( $this->include_cols ) && ! in_array( $column, $this->include_cols ) )
+				continue;
+
+			$expression = "`{$column}`";
+			$likes = array( );
+			foreach( $pairs as $pair_search => $pair_replace ) {
+				$expression = sprintf( 'REPLACE(%s, %s, %s)', $expression, $this->db_escape( $pair_search ), $this->db_escape( $pair_replace ) );
+				$likes[] = "`{$column}` LIKE " . $this->db_escape( '%' . addcslashes( $pair_search, '%_\\' ) . '%' );
+			}
+			$like = '(' . implode( ' OR ', $likes ) . ')';
+
+			if ( ! $sql_replace ) {
+				$select[] = "1 AS `srdb_serialised_{$i}`";
+				$where[] = $like;
+				continue;
+			}
+
+			$result = $this->db_update( "UPDATE `{$table}` SET `{$column}` = {$expression} WHERE {$like} AND `{$column}` NOT REGEXP {$serialised}" );
+			if ( ! is_int( $result ) && ! $result )
+				$this->add_error( $this->db_error( ), 'results' );
+			else
+				$changes += is_int( $result ) ? $result : mysqli_affected_rows( $this->db );
+
+			$select[] = "`{$column}` REGEXP {$serialised} AS `srdb_serialised_{$i}`";
+			$where[] = "({$like} AND `{$column}` REGEXP {$serialised})";
+		}
+
+		// nothing to look at in PHP
+		if ( empty( $where ) )
+			$where[] = '0';
+
+		return array( implode( ', ', $select ), implode( ' OR ', $where ), $changes );
+	}
+
+
+	/**
+	 * Whether two searches can match overlapping text: one contains the other,
+	 * or one ends with what the other starts with
+	 *
+	 * @param string $a
+	 * @param string $b
+	 *
+	 * @return bool
+	 */
+	public function searches_overlap( $a, $b ) {
+		if ( strpos( $a, $b ) !== false || strpos( $b, $a ) !== false )
+			return true;
+		$max = min( strlen( $a ), strlen( $b ) ) - 1;
+		for ( $length = 1; $length <= $max; $length++ ) {
+			if ( substr( $a, -$length ) === substr( $b, 0, $length ) )
+				return true;
+			if ( substr( $b, -$length ) === substr( $a, 0, $length ) )
+				return true;
+		}
+		return false;
+	}
+
+
 	public function do_column() {
 
 	}
@@ -1181,6 +1318,12 @@ class icit_srdb {
 	public function str_replace( $search, $replace, $string, &$count = 0 ) {
 		if ( $this->get( 'regex' ) ) {
 			return preg_replace( $search, $replace, $string, -1, $count );
+		} elseif ( is_array( $search ) ) {
+			// all pairs in one pass, longest search first, so no pair replaces
+			// in what another one put in
+			$replaced = strtr( $string, array_combine( $search, $replace ) );
+			$count += $replaced === $string ? 0 : 1;
+			return $replaced;
 		} elseif( function_exists( 'mb_split' ) ) {
 			return self::mb_str_replace( $search, $replace, $string, $count );
 		} else {